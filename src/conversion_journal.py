@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import threading
+
+from fingerprint import file_fingerprint
+
+# Stored in the output directory, next to the charts it lists.
+JOURNAL_FILENAME = 'journal.jsonl'
+
+HASH_CHUNK_SIZE = 1 << 20
+
+def file_hash(path):
+    """ :return: The SHA-256 of a file as a hex string. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ConversionJournal:
+    """
+    An append-only record of the charts that were converted completely, one JSON line each: the vox file and its
+    fingerprint, and the chart written from it along with its SHA-256. Every line is flushed to disk as soon as it is
+    written, so a run that dies keeps every entry before the crash. A line torn by a crash is dropped when the journal
+    is read back.
+    """
+    def __init__(self, path, resume):
+        """
+        :param resume: Keep the entries of the previous run and append to them. Otherwise the journal starts empty.
+        """
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            self._read()
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def _read(self):
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        # Anything after the last newline was being written when the previous run stopped.
+        complete = data[:data.rfind(b'\n') + 1]
+        for line in complete.decode('utf-8', errors='replace').splitlines():
+            try:
+                entry = json.loads(line)
+                self.entries[entry['input']] = entry
+            except (ValueError, KeyError, TypeError):
+                continue
+        if len(complete) != len(data):
+            with open(self.path, 'r+b') as file:
+                file.truncate(len(complete))
+
+    def is_done(self, input_path, output_path):
+        """ :return: True if the chart was converted from the same vox file and is still as it was written. """
+        entry = self.entries.get(input_path)
+        if entry is None or entry.get('output') != output_path or not os.path.exists(output_path):
+            return False
+        try:
+            return entry.get('input_fingerprint') == file_fingerprint(input_path) and \
+                entry.get('sha256') == file_hash(output_path)
+        except OSError:
+            return False
+
+    def record(self, input_path, output_path):
+        """ Add a finished chart. Safe to call from several threads. """
+        entry = {'input': input_path, 'input_fingerprint': file_fingerprint(input_path), 'output': output_path,
+                 'sha256': file_hash(output_path)}
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[input_path] = entry
+
+    def manifest(self):
+        """ :return: The entry of every chart finished by this run or, when resuming, by the runs before it. """
+        with self.lock:
+            return sorted(self.entries.values(), key=lambda entry: entry['output'])
+
+    def close(self):
+        self.file.close()
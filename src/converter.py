@@ -1,23 +1,47 @@
 #!/usr/bin/env python3.7
 from enum import Enum, auto
 from glob import glob
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import threading
+import multiprocessing
+import heapq
+import cProfile
+import pstats
+import tracemalloc
 
 from recordclass import dataobject
 from xml.etree import ElementTree
 import traceback
 import random
 import math
+import copy
+import pickle
+import io
 import shutil
+import tempfile
 import time
+import json
+import zlib
 import configparser
 
 import sys, os
 import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    # --watch polls the directories instead.
+    INotify = None
 
 from os.path import splitext as splitx
 
 import ksh_effects
+import conversion_journal
+import run_log
+import run_report
+import volume_table
 
 # Ticks per a beat of /4 time
 TICKS_PER_BEAT = 48
@@ -38,38 +62,50 @@ FX_CHIP_SOUND_VOL_PERCENT = 27
 
 MAX_MEASURES = 999
 
+# Roughly how many bytes of memory a parsed and written chart takes per byte of its vox file.
+VOX_MEMORY_FACTOR = 32
+
+# Temporary files are created private, so they are given the permissions a new file would normally get.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 class Debug:
     class State(Enum):
         INPUT = auto()
         OUTPUT = auto()
 
-    class Level(Enum):
-        ABNORMALITY = 'abnormal'
-        WARNING = 'warning'
-        ERROR = 'error'
+    Level = run_report.Level
 
-    def __init__(self, exceptions_file):
+    def __init__(self):
         self.state = None
         self.input_filename = None
         self.output_filename = None
         self.current_line_num = 0
         self.exceptions_count = {level: 0 for level in Debug.Level}
-        self.exceptions_file = open(exceptions_file, 'w+')
+
+        # Per-chart profiling data, reset along with the exception counts.
+        self.timings = {}
+        self.counters = {}
+
+        # Totals across every chart this Debug has seen, plus one report entry per chart.
+        self.total_timings = {}
+        self.total_counters = {}
+        self.total_exceptions = {level: 0 for level in Debug.Level}
+        self.chart_reports = []
 
     def reset(self):
         for level in self.Level:
             self.exceptions_count[level] = 0
-
-    def close(self):
-        self.exceptions_file.close()
+        self.timings = {}
+        self.counters = {}
 
     def current_filename(self):
         return self.input_filename if self.state == self.State.INPUT else self.output_filename
 
     def record(self, level, tag, message):
         self.exceptions_count[level] += 1
-        print(f'{self.current_filename()}:{self.current_line_num}\n{level.value} / {tag}: {message}\n',
-              file=self.exceptions_file)
+        run_log.emit('issue', message, level=level.value, tag=tag, file=self.current_filename(),
+                     line=self.current_line_num)
 
     def has_issues(self):
         for level in self.Level:
@@ -80,6 +116,149 @@ class Debug:
     def record_last_exception(self, level=Level.WARNING, tag='python_exception', trace=False):
         self.record(level, tag, str(sys.exc_info()[1]) + '\n\tTraceback:\n' + '\n'.join(traceback.format_tb(sys.exc_info()[2])))
 
+    @contextmanager
+    def phase(self, name):
+        """ Time the enclosed block, adding its wall and CPU time to the named phase of the current chart. """
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            timing = self.timings.setdefault(name, [0.0, 0.0])
+            timing[0] += time.perf_counter() - wall_start
+            timing[1] += time.thread_time() - cpu_start
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def finish_chart(self):
+        """ Fold the current chart's timings, counters and exception counts into the run totals. """
+        for name, (wall, cpu) in self.timings.items():
+            total = self.total_timings.setdefault(name, [0.0, 0.0])
+            total[0] += wall
+            total[1] += cpu
+        for name, amount in self.counters.items():
+            self.total_counters[name] = self.total_counters.get(name, 0) + amount
+        for level in self.Level:
+            self.total_exceptions[level] += self.exceptions_count[level]
+
+        self.chart_reports.append({
+            'input': self.input_filename,
+            'output': self.output_filename,
+            'timings': {name: {'wall': wall, 'cpu': cpu} for name, (wall, cpu) in self.timings.items()},
+            'counters': dict(self.counters),
+            'issues': {level.value: count for level, count in self.exceptions_count.items()}
+        })
+
+    @staticmethod
+    def run_report(debug_objects):
+        """ Aggregate the totals of several Debug objects (one per worker) into a single report. """
+        report = {'phases': {}, 'counters': {}, 'issues': {level.value: 0 for level in Debug.Level}, 'charts': []}
+        for d in debug_objects:
+            for name, (wall, cpu) in d.total_timings.items():
+                phase = report['phases'].setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+                phase['wall'] += wall
+                phase['cpu'] += cpu
+            for name, amount in d.total_counters.items():
+                report['counters'][name] = report['counters'].get(name, 0) + amount
+            for level, count in d.total_exceptions.items():
+                report['issues'][level.value] += count
+            report['charts'] += d.chart_reports
+        return report
+
+class ChartProfiler:
+    """ Optional cProfile and tracemalloc instrumentation around the parse and write steps of a single chart. """
+    TOP_STATS = 40
+    # Only one cProfile profiler can be active in a process at a time (enabling a second one raises on Python 3.12+),
+    #  so profiled blocks of different worker threads take turns.
+    CPROFILE_LOCK = threading.Lock()
+
+    def __init__(self, chart_name, use_cprofile, use_tracemalloc, threshold_ms):
+        self.chart_name = chart_name
+        self.profile = cProfile.Profile() if use_cprofile else None
+        self.use_tracemalloc = use_tracemalloc and tracemalloc.is_tracing()
+        self.threshold_ms = threshold_ms
+        self.elapsed = 0.0
+        self.start_snapshot = None
+        self.end_snapshot = None
+
+    @classmethod
+    def from_args(cls, vox_path):
+        global args
+        return cls(splitx(os.path.basename(vox_path))[0], args.profile, args.trace_malloc, args.profile_threshold)
+
+    def enabled(self):
+        return self.profile is not None or self.use_tracemalloc
+
+    @contextmanager
+    def run(self):
+        """ Profile the enclosed block. May be entered several times; the results accumulate. """
+        if not self.enabled():
+            yield
+            return
+
+        if self.use_tracemalloc and self.start_snapshot is None:
+            self.start_snapshot = tracemalloc.take_snapshot()
+        if self.profile is not None:
+            self.CPROFILE_LOCK.acquire()
+        start = time.perf_counter()
+        try:
+            if self.profile is not None:
+                self.profile.enable()
+            yield
+        finally:
+            self.elapsed += time.perf_counter() - start
+            if self.profile is not None:
+                self.profile.disable()
+                self.CPROFILE_LOCK.release()
+            if self.use_tracemalloc:
+                self.end_snapshot = tracemalloc.take_snapshot()
+
+    def dump(self):
+        """
+        Write the collected data to the debug directory if the chart was slower than the threshold.
+        :return: True if anything was written.
+        """
+        if not self.enabled() or self.elapsed * 1000 < self.threshold_ms:
+            return False
+
+        if self.profile is not None:
+            self.profile.dump_stats(f'debug/profile_{self.chart_name}.prof')
+            with open(f'debug/profile_{self.chart_name}.txt', 'w') as file:
+                stats = pstats.Stats(self.profile, stream=file)
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.TOP_STATS)
+
+        if self.start_snapshot is not None and self.end_snapshot is not None:
+            with open(f'debug/alloc_{self.chart_name}.txt', 'w') as file:
+                print(f'Top allocations for {self.chart_name} ({truncate(self.elapsed * 1000, 1)}ms):', file=file)
+                for stat in self.end_snapshot.compare_to(self.start_snapshot, 'lineno')[:self.TOP_STATS]:
+                    print(stat, file=file)
+
+        return True
+
+class MemoryBudget:
+    """
+    Limits the number of bytes held at once by parsed charts or by media copies. `acquire` blocks until enough has been
+    released. A request larger than the whole budget goes through once nothing else is held, so it never waits forever.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        """ :return: The amount reserved, to be passed to `release`. """
+        amount = min(amount, self.limit)
+        with self.condition:
+            self.condition.wait_for(lambda: self.used + amount <= self.limit)
+            self.used += amount
+        return amount
+
+    def release(self, amount):
+        with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
 def truncate(x, digits) -> float:
     stepper = 10.0 ** digits
     return math.trunc(stepper * x) / stepper
@@ -639,6 +818,584 @@ class KshLineBuf:
 
         return buf
 
+class KshMeasureGrid:
+    """
+    Renders the note lines of a chart a measure at a time. Each tick is a fixed width row of a byte grid, so holds and
+    laser continuations are filled in as column slices instead of line by line. Meta lines, beat comments and spins are
+    kept in sparse dicts and merged in when the measure is written.
+    """
+    EMPTY_ROW = b'0000|00|--\n'
+    ROW_WIDTH = len(EMPTY_ROW)
+    COLUMNS = {Button.BT_A: 0, Button.BT_B: 1, Button.BT_C: 2, Button.BT_D: 3, Button.FX_L: 5, Button.FX_R: 6,
+               LaserSide.LEFT: 8, LaserSide.RIGHT: 9}
+    # BT and FX use opposite characters for chips and holds.
+    BUTTON_CHARS = {KshLineBuf.ButtonState.PRESS: (ord('1'), ord('2')),
+                    KshLineBuf.ButtonState.HOLD: (ord('2'), ord('1'))}
+
+    def __init__(self):
+        self.first_tick = 0
+        self.end_tick = 0
+        self.rows = bytearray()
+        self.comments = {}
+        self.meta = {}
+        self.spins = {}
+        # The (start, end) tick of the current hold of each button.
+        self.holds = {}
+        # The tick each ongoing laser started being continued on.
+        self.laser_since = {s: None for s in LaserSide}
+        # Slams that may still have lines to write, as (start tick, slam), oldest first.
+        self.slams = []
+
+    def begin_measure(self, first_tick, tick_count):
+        self.first_tick = first_tick
+        self.end_tick = first_tick + tick_count
+        self.rows = bytearray(self.EMPTY_ROW * tick_count)
+        self.comments = {}
+        self.meta = {}
+        self.spins = {}
+
+    def _column(self, column, start, end):
+        """ :return: The slice of the rows covering one column between two ticks, clipped to this measure. """
+        start = max(start, self.first_tick) - self.first_tick
+        end = min(end, self.end_tick) - self.first_tick
+        if start >= end:
+            return None
+        return slice(start * self.ROW_WIDTH + column, end * self.ROW_WIDTH + column, self.ROW_WIDTH)
+
+    def stamp(self, tick, buffer: KshLineBuf):
+        """ Copy the notes, meta lines and spin of a single line onto a tick. """
+        offset = (tick - self.first_tick) * self.ROW_WIDTH
+        for button, state in buffer.buttons.items():
+            if state != KshLineBuf.ButtonState.NONE:
+                self.rows[offset + self.COLUMNS[button]] = self.BUTTON_CHARS[state][button.is_fx()]
+        for side, value in buffer.lasers.items():
+            if value != '-':
+                self.rows[offset + self.COLUMNS[side]] = ord(value)
+        if buffer.meta:
+            self.meta.setdefault(tick, []).extend(buffer.meta)
+        if buffer.spin:
+            self.spins[tick] = buffer.spin
+
+    def comment(self, tick, line):
+        self.comments[tick] = line
+
+    def add_meta(self, tick, line):
+        self.meta.setdefault(tick, []).append(line)
+
+    def meta_count(self, tick):
+        return len(self.meta.get(tick, ()))
+
+    def _fill_hold(self, button, end):
+        start, hold_end = self.holds[button]
+        column = self._column(self.COLUMNS[button], start, min(end, hold_end))
+        if column is not None:
+            char = self.BUTTON_CHARS[KshLineBuf.ButtonState.HOLD][button.is_fx()]
+            self.rows[column] = bytes([char]) * len(self.rows[column])
+
+    def hold(self, button, start, end):
+        """ Start a hold. A hold that is still going on the same button is cut off where this one starts. """
+        if button in self.holds:
+            self._fill_hold(button, start)
+        self.holds[button] = (start, end)
+
+    def _fill_laser(self, side, end):
+        column = self._column(self.COLUMNS[side], self.laser_since[side], end)
+        if column is not None:
+            self.rows[column] = self.rows[column].replace(b'-', b':')
+
+    def laser_on(self, side, tick):
+        """ Continue the laser on empty lines from this tick on. """
+        if self.laser_since[side] is None:
+            self.laser_since[side] = tick
+
+    def laser_off(self, side, end):
+        """ Stop continuing the laser before the given tick. """
+        if self.laser_since[side] is not None:
+            self._fill_laser(side, end)
+            self.laser_since[side] = None
+
+    def slam(self, tick, slam: LaserSlam):
+        self.slams.append((tick, slam))
+
+    def write(self, file):
+        """
+        Fill in the ongoing holds, lasers and slams, and write every line of the measure. Without a file, only the
+        holds and slams that ended are forgotten.
+        """
+        if file is None:
+            self.holds = {button: hold for button, hold in self.holds.items() if hold[1] > self.end_tick}
+            self.slams = [(start, slam) for start, slam in self.slams if start + SLAM_TICKS >= self.end_tick]
+            return
+
+        for button in list(self.holds):
+            self._fill_hold(button, self.end_tick)
+            if self.holds[button][1] <= self.end_tick:
+                del self.holds[button]
+
+        for side in LaserSide:
+            if self.laser_since[side] is not None:
+                self._fill_laser(side, self.end_tick)
+
+        # Slams cover the lines after the one they start on, and older slams win over newer ones on the same side.
+        for start, slam in reversed(self.slams):
+            column = self.COLUMNS[slam.side()]
+            for elapsed in range(1, SLAM_TICKS + 1):
+                tick = start + elapsed
+                if self.first_tick <= tick < self.end_tick:
+                    value = slam.end.position_ksh() if elapsed == SLAM_TICKS else ':'
+                    self.rows[(tick - self.first_tick) * self.ROW_WIDTH + column] = ord(value)
+        self.slams = [(start, slam) for start, slam in self.slams if start + SLAM_TICKS >= self.end_tick]
+
+        text = self.rows.decode('ascii')
+        parts = []
+        position = 0
+        for tick in sorted(self.comments.keys() | self.meta.keys() | self.spins.keys()):
+            row = (tick - self.first_tick) * self.ROW_WIDTH
+            parts.append(text[position:row])
+            if tick in self.comments:
+                parts.append(self.comments[tick] + '\n')
+            for line in self.meta.get(tick, ()):
+                parts.append(line + '\n')
+            if tick in self.spins:
+                parts.append(text[row:row + self.ROW_WIDTH - 1] + self.spins[tick] + '\n')
+                position = row + self.ROW_WIDTH
+            else:
+                position = row
+        parts.append(text[position:])
+        file.write(''.join(parts))
+
+class KshWriter:
+    """
+    Writes the notes of a chart measure by measure. Everything carried from one measure to the next (the current tick,
+    holds, lasers, slams, the last filter, SpController nodes and the time signature) lives on the writer, so a copy
+    taken between measures can carry on writing from there in another process.
+    """
+    def __init__(self, vox, render_grid, do_media):
+        self.events = vox.events
+        self.effect_defines = vox.effect_defines
+        self.effect_fallback = vox.effect_fallback
+        self.do_media = do_media
+
+        # The number of tick lines printed so far. Holds, slams and SpController nodes last a number of these lines, so
+        #  they are tracked by the tick they end on instead of being counted down every line.
+        self.tick = 0
+        # Breaks ties between queue entries that end on the same tick.
+        self.queue_order = 0
+
+        # The end tick of the currently active BT holds, and a heap of (end tick, order, button) to expire them.
+        self.hold_ends = {}
+        self.hold_queue = []
+
+        # The currently active SpController nodes as (node, end tick), and a heap of (end tick, param order, order,
+        #  param) to print their end values.
+        self.ongoing_spcontroller_events = {p: None for p in SpcParam}
+        self.spcontroller_queue = []
+
+        # Whether there is an ongoing laser on either side.
+        self.lasers = {s: None for s in LaserSide}
+        # The tick each unresolved slam started on. Every slam lasts SLAM_TICKS, so this is also the order they end in.
+        self.slam_starts = {}
+        self.last_laser_timing = {s: None for s in LaserSide}
+        self.last_filter = KshFilter.PEAK
+        self.laser_range = {}
+        self.current_timesig = self.events[Timing(1, 1, 0)][EventKind.TIMESIG]
+
+        # With the grid renderer, lines are only built for ticks that have events, and whole measures are written at
+        #  once. Otherwise every tick is printed as its own line.
+        self.grid = KshMeasureGrid() if render_grid else None
+        # The timings that have events by measure, set by `index_timings`.
+        self.measure_timings = None
+
+    def _next_order(self):
+        self.queue_order += 1
+        return self.queue_order
+
+    def _begin_measure(self, measure):
+        """ :return: The number of ticks in each beat of the measure. """
+        now = Timing(measure, 1, 0)
+
+        # Laser range resets every measure in ksh.
+        self.laser_range = {LaserSide.LEFT: 1, LaserSide.RIGHT: 1}
+
+        if now in self.events and EventKind.TIMESIG in self.events[now]:
+            self.current_timesig = self.events[now][EventKind.TIMESIG]
+
+        debug().count('ticks', self.current_timesig.top * self.current_timesig.ticks_per_beat())
+
+        beat_ticks = int(float(TICKS_PER_BEAT) * (4 / self.current_timesig.bottom))
+        if self.grid is not None:
+            self.grid.begin_measure(self.tick, self.current_timesig.top * beat_ticks)
+        return beat_ticks
+
+    def write_measure(self, measure, file):
+        beat_ticks = self._begin_measure(measure)
+        events = self.events
+        grid = self.grid
+        debug_info = debug()
+
+        if EventKind.TIMESIG in events.get(Timing(measure, 1, 0), ()):
+            print(f'beat={self.current_timesig.top}/{self.current_timesig.bottom}', file=file)
+
+        for b in range(self.current_timesig.top):
+            # Vox beats are also 1-indexed.
+            beat = b + 1
+
+            if grid is not None:
+                grid.comment(self.tick, f'// #{measure},{beat}')
+            else:
+                print(f'// #{measure},{beat}', file=file)
+
+            for o in range(beat_ticks):
+                # However, vox offsets are 0-indexed.
+
+                now = Timing(measure, beat, o)
+
+                if now in events:
+                    buffer = KshLineBuf()
+                    self._process_events(now, buffer)
+                    self._finish_tick(buffer)
+                elif grid is None:
+                    buffer = KshLineBuf()
+                    self._finish_tick(buffer)
+                elif self.slam_starts or (self.spcontroller_queue and self.spcontroller_queue[0][0] <= self.tick):
+                    # Nothing else happens on a tick without events when the grid fills in holds and lasers.
+                    self._finish_tick(None)
+
+                if grid is not None:
+                    debug_info.current_line_num += 1 + grid.meta_count(self.tick)
+                else:
+                    out = buffer.out()
+
+                    print(out, file=file)
+
+                    debug_info.current_line_num += len(out.split('\n'))
+                self.tick += 1
+
+        if grid is not None:
+            grid.write(file)
+        print('--', file=file)
+
+        debug_info.current_line_num += 1
+
+    def skip_measure(self, measure):
+        """
+        Bring the state up to the end of a measure without writing it. Only the ticks that have events or where a slam
+        or SpController node ends are visited. Issues are recorded with the same line numbers as when writing. Needs the
+        grid renderer, which does not have to visit every tick to keep track of holds and laser continuations.
+        """
+        beat_ticks = self._begin_measure(measure)
+        first_tick = self.tick
+        tick_count = self.current_timesig.top * beat_ticks
+        line_num = debug().current_line_num
+        meta_count = 0
+
+        def tick_of(timing):
+            if timing.measure != measure or not 1 <= timing.beat <= self.current_timesig.top \
+                    or not 0 <= timing.offset < beat_ticks:
+                return None
+            return first_tick + (timing.beat - 1) * beat_ticks + timing.offset
+
+        # Timings of this measure that have events, by tick.
+        timings = {}
+        for timing in self.measure_timings.pop(measure, ()):
+            tick = tick_of(timing)
+            if tick is not None:
+                timings[tick] = timing
+        queue = list(timings)
+        heapq.heapify(queue)
+
+        while True:
+            candidates = [first_tick + tick_count]
+            if queue:
+                candidates.append(queue[0])
+            if self.spcontroller_queue:
+                candidates.append(self.spcontroller_queue[0][0])
+            if self.slam_starts:
+                candidates.append(min(self.slam_starts.values()) + SLAM_TICKS)
+            tick = min(candidates)
+            if tick >= first_tick + tick_count:
+                break
+            while queue and queue[0] == tick:
+                heapq.heappop(queue)
+
+            self.tick = tick
+            debug().current_line_num = line_num + (tick - first_tick) + meta_count
+            now = Timing(measure, (tick - first_tick) // beat_ticks + 1, (tick - first_tick) % beat_ticks)
+            buffer = None
+            if now in self.events:
+                buffer = KshLineBuf()
+                self._process_events(now, buffer)
+                # Laser nodes can be pushed up to 8 ticks forward, possibly into the next measure.
+                for ticks in range(1, 9):
+                    pushed = now.add(ticks, self.current_timesig)
+                    if pushed not in self.events:
+                        continue
+                    pushed_tick = tick_of(pushed)
+                    if pushed_tick is None:
+                        self.measure_timings.setdefault(pushed.measure, set()).add(pushed)
+                    elif pushed_tick not in timings:
+                        timings[pushed_tick] = pushed
+                        heapq.heappush(queue, pushed_tick)
+            self._finish_tick(buffer)
+            meta_count += self.grid.meta_count(tick)
+
+        self.tick = first_tick + tick_count
+        self.grid.write(None)
+        debug().current_line_num = line_num + tick_count + meta_count + 1
+
+    def index_timings(self):
+        """ Index the timings that have events by measure, for `skip_measure`. """
+        self.measure_timings = {}
+        for timing in self.events:
+            self.measure_timings.setdefault(timing.measure, set()).add(timing)
+
+    def copy_from(self, measure, end_measure):
+        """
+        :return: A pickled copy of the writer that writes the measures from `measure` up to `end_measure`, with only the
+        events it needs.
+        """
+        writer = copy.copy(self)
+        writer.measure_timings = None
+        # Laser nodes near the end of the range look a few ticks past it.
+        writer.events = {t: e for t, e in self.events.items() if measure <= t.measure <= end_measure + 1}
+        return pickle.dumps(writer)
+
+    def _process_events(self, now, buffer):
+        for kind, event in self.events[now].items():
+            if kind == EventKind.TIMESIG and (now.beat != 1 or now.offset != 0):
+                raise KshConvertError('time signature change in the middle of a measure')
+
+            elif kind == EventKind.BPM:
+                event: float
+                buffer.meta.append(f't={str(event).rstrip("0").rstrip(".").strip()}')
+
+            elif kind == EventKind.STOP:
+                event: int
+                buffer.meta.append(f'stop={event}')
+
+            elif type(kind) is tuple and kind[0] == EventKind.SPCONTROLLER:
+                event: CameraNode
+                cam_param: SpcParam = kind[1]
+                if cam_param.to_ksh_value() is not None:
+                    if self.ongoing_spcontroller_events[cam_param] is not None and self.ongoing_spcontroller_events[cam_param][1] != self.tick:
+                        debug().record(Debug.Level.WARNING, 'spnode_output', f'spcontroller node at {now} interrupts another of same kind ({cam_param})')
+                    # Nodes with a negative duration never end.
+                    end_tick = self.tick + event.duration if event.duration >= 0 else math.inf
+                    self.ongoing_spcontroller_events[cam_param] = (event, end_tick)
+                    if not cam_param.is_state():
+                        heapq.heappush(self.spcontroller_queue, (end_tick, cam_param.value, self._next_order(), cam_param))
+                    buffer.meta.append(f'{cam_param.to_ksh_name()}={cam_param.to_ksh_value(event.start_param)}')
+                elif cam_param.is_state():
+                    buffer.meta.append(f'{cam_param.to_ksh_name()}={event.duration}')
+
+            elif kind == EventKind.TILTMODE:
+                event: TiltMode
+                buffer.meta.append(f'tilt={event.to_ksh_name()}')
+
+            elif type(kind) is tuple and kind[0] == EventKind.TRACK:
+                if kind[1] == 1 or kind[1] == 8:
+                    # Laser
+                    if type(event) is LaserSlam:
+                        event: LaserSlam
+                        # TODO Laser countdown for different timesigs
+                        laser = event.start
+
+                        if event.side in map(lambda x: x.side(), self.slam_starts):
+                            raise KshConvertError('new laser node spawn while trying to resolve slam')
+
+                        self.slam_starts[event] = self.tick
+                        if self.grid is not None:
+                            self.grid.slam(self.tick, event)
+
+                        if laser.roll_kind is not None:
+                            if buffer.spin != '':
+                                debug().record(Debug.Level.WARNING, 'ksh_laser', 'spin on both lasers')
+
+                            if laser.roll_kind.value <= 3:
+                                buffer.spin = '@'
+                                if event.direction() == LaserSlam.Direction.LEFT:
+                                    buffer.spin += '('
+                                else:
+                                    buffer.spin += ')'
+
+                                # My assumption right now is that the MEASURE kind will always take one
+                                # measure's worth of ticks. Likewise for the other ones.
+                                if laser.roll_kind == RollKind.MEASURE:
+                                    buffer.spin += str(int(self.current_timesig.top * self.current_timesig.ticks_per_beat() * 0.85))
+                                elif laser.roll_kind == RollKind.HALF_MEASURE:
+                                    buffer.spin += str(int((self.current_timesig.top * self.current_timesig.ticks_per_beat()) / 2.95))
+                                elif laser.roll_kind == RollKind.THREE_BEAT:
+                                    buffer.spin += str(int((self.current_timesig.top * self.current_timesig.ticks_per_beat()) * 0.62))
+
+                            elif laser.roll_kind == RollKind.CANCER:
+                                # TODO This roll.
+                                buffer.spin = '@'
+                                if event.direction() == LaserSlam.Direction.LEFT:
+                                    buffer.spin += '('
+                                else:
+                                    buffer.spin += ')'
+                                buffer.spin += str(self.current_timesig.top * self.current_timesig.ticks_per_beat() * 2)
+                            elif laser.roll_kind == RollKind.SWING:
+                                buffer.spin = '@'
+                                if event.direction() == LaserSlam.Direction.LEFT:
+                                    buffer.spin += '<'
+                                else:
+                                    buffer.spin += '>'
+                                buffer.spin += str(int((self.current_timesig.top * self.current_timesig.ticks_per_beat()) * 0.62))
+
+                        # noinspection PyUnusedLocal
+                        event: LaserNode = event.start
+
+                    event: LaserNode
+
+                    # KSH defines anything less than a 32th to be a slam, but some vox files
+                    # have nodes less than a 32th apart from each other. To counter this, we
+                    # just push laser nodes a tick forward until they're more than a 32th
+                    # apart.
+                    skip_laser = False
+                    thirtysecondth_ticks = int((4 * int(float(TICKS_PER_BEAT) * (4.0 / self.current_timesig.bottom))) / 32)
+                    if self.last_laser_timing[event.side] is not None and now.diff(self.last_laser_timing[event.side], self.current_timesig) == thirtysecondth_ticks:
+                        # Push it a tick forward to avoid being interpreted as a slam.
+                        if now.add(1, self.current_timesig) not in self.events:
+                            self.events[now.add(1, self.current_timesig)] = {}
+                        self.events[Timing(now.measure, now.beat, now.offset + 1)][kind] = event
+                        skip_laser = True
+
+                        # Look ahead and push other nodes forward.
+                        no_more_pushes = False
+                        while not no_more_pushes:
+                            no_more_pushes = True
+                            for i in range(6, 1, -1):
+                                lookahead_timing = now.add(1, self.current_timesig).add(i, self.current_timesig)
+                                if lookahead_timing in self.events and kind in self.events[lookahead_timing]:
+                                    ev = self.events[lookahead_timing][kind]
+                                    timing_plus_one = lookahead_timing.add(1, self.current_timesig)
+                                    if timing_plus_one not in self.events:
+                                        self.events[timing_plus_one] = {}
+                                    self.events[Timing(lookahead_timing.measure, lookahead_timing.beat, lookahead_timing.offset + 1)][kind] = ev
+                                    del self.events[lookahead_timing][kind]
+                                    no_more_pushes = False
+
+                    if event.range != 1:
+                        buffer.meta.append(f'laserrange_{event.side.to_letter()}={event.range}x')
+                        self.laser_range[event.side] = event.range
+
+                    if event.node_cont != LaserCont.END and event.filter != self.last_filter:
+                        if self.last_filter is None:
+                            buffer.meta.append(f'pfiltergain={KSH_DEFAULT_FILTER_GAIN}')
+
+                        if event.filter is None:
+                            buffer.meta.append(f'pfiltergain=0')
+                        else:
+                            buffer.meta.append(f'filtertype={event.filter.to_ksh_name()}')
+
+                        self.last_filter = event.filter
+
+                    if not skip_laser:
+                        if event.node_cont == LaserCont.START:
+                            self.lasers[event.side] = True
+                            if self.grid is not None:
+                                self.grid.laser_on(event.side, self.tick)
+                        elif event.node_cont == LaserCont.END:
+                            self.lasers[event.side] = False
+                            if self.grid is not None:
+                                self.grid.laser_off(event.side, self.tick)
+                        buffer.lasers[event.side] = event.position_ksh()
+
+                    self.last_laser_timing[event.side] = now
+
+                else:
+                    # Button
+                    event: ButtonPress
+                    if event.duration != 0:
+                        if event.button.is_fx():
+                            letter = 'l' if event.button == Button.FX_L else 'r'
+                            try:
+                                if type(event.effect) is int:
+                                    effect_string = self.effect_defines[event.effect].fx_change(event.effect, duration=event.duration) if event.effect >= 0 else self.effect_fallback.fx_change(EFFECT_FALLBACK_NAME)
+                                else:
+                                    effect_string = event.effect[0].to_ksh_name(event.effect[1])
+                                buffer.meta.append(f'fx-{letter}={effect_string}')
+                            except KeyError:
+                                debug().record_last_exception(tag='button_fx')
+                        buffer.buttons[event.button] = KshLineBuf.ButtonState.HOLD
+                        # Holds with a negative duration never end.
+                        end_tick = self.tick + event.duration if event.duration > 0 else math.inf
+                        if self.grid is not None:
+                            self.grid.hold(event.button, self.tick, end_tick)
+                        else:
+                            self.hold_ends[event.button] = end_tick
+                            heapq.heappush(self.hold_queue, (end_tick, self._next_order(), event.button))
+                    elif self.do_media:
+                        # Check for a chip sound.
+                        buffer.buttons[event.button] = KshLineBuf.ButtonState.PRESS
+                        event.effect: int
+                        if event.button.is_fx() and event.effect is not None:
+                            letter = 'l' if event.button == Button.FX_L else 'r'
+                            buffer.meta.append(f'fx-{letter}_se=fxchip_{event.effect}{FX_CHIP_SOUND_EXTENSION};{FX_CHIP_SOUND_VOL_PERCENT}')
+
+    def _finish_tick(self, buffer):
+        """ End SpController nodes, holds and slams, and continue lasers on the current tick. """
+        tick = self.tick
+        grid = self.grid
+
+        if grid is not None and buffer is not None:
+            grid.stamp(tick, buffer)
+
+        while self.spcontroller_queue and self.spcontroller_queue[0][0] <= tick:
+            _, _, _, cam_param = heapq.heappop(self.spcontroller_queue)
+            # Skip nodes that were replaced by another of the same kind.
+            if self.ongoing_spcontroller_events[cam_param] is not None and \
+                    self.ongoing_spcontroller_events[cam_param][1] == tick:
+                # SpController node ended and there's not another one after.
+                event: CameraNode = self.ongoing_spcontroller_events[cam_param][0]
+                line = f'{cam_param.to_ksh_name()}={cam_param.to_ksh_value(event.end_param)}'
+                if grid is not None:
+                    grid.add_meta(tick, line)
+                else:
+                    buffer.meta.append(line)
+                self.ongoing_spcontroller_events[cam_param] = None
+
+        if grid is not None:
+            # The grid fills in holds, lasers and slams itself, only the end of each slam matters here.
+            for slam in list(self.slam_starts):
+                if tick - self.slam_starts[slam] == SLAM_TICKS:
+                    del self.slam_starts[slam]
+                    if slam.end.node_cont == LaserCont.END:
+                        self.lasers[slam.side()] = False
+                        grid.laser_off(slam.side(), tick + 1)
+            return
+
+        while self.hold_queue and self.hold_queue[0][0] <= tick:
+            end_tick, _, button = heapq.heappop(self.hold_queue)
+            if self.hold_ends.get(button) == end_tick:
+                del self.hold_ends[button]
+        for button in self.hold_ends:
+            buffer.buttons[button] = KshLineBuf.ButtonState.HOLD
+
+        for side in LaserSide:
+            if buffer.lasers[side] == '-' and self.lasers[side]:
+                buffer.lasers[side] = ':'
+
+        # Older slams are written last so they win over newer ones on the same side.
+        for slam in reversed(list(self.slam_starts)):
+            elapsed = tick - self.slam_starts[slam]
+            if elapsed == SLAM_TICKS:
+                buffer.lasers[slam.side()] = slam.end.position_ksh()
+                del self.slam_starts[slam]
+                if slam.end.node_cont == LaserCont.END:
+                    self.lasers[slam.side()] = False
+            elif elapsed > 0:
+                buffer.lasers[slam.side()] = ':'
+
+def write_measure_range(writer, measure, end_measure):
+    """ Write measures with a writer pickled by `KshWriter.copy_from`. Runs in a process of `measure_pool`. """
+    writer = pickle.loads(writer)
+    file = io.StringIO()
+    for m in range(measure, end_measure):
+        writer.write_measure(m, file)
+    return file.getvalue()
+
 class Vox:
     class State(Enum):
         @classmethod
@@ -753,6 +1510,24 @@ class Vox:
         else:
             return f'{int(int(self.get_metadata("bpm_min")) / 100)}-{int(int(self.get_metadata("bpm_max")) / 100)}'
 
+    def music_volume(self, using_difficulty_audio):
+        """
+        The music volume for the KSH header. This is the DB volume, scaled towards the target loudness if one was given
+        and prepare_audio measured the loudness of the audio file.
+        """
+        global args
+
+        volume = self.get_metadata('volume')
+        if args.target_loudness is None:
+            return volume
+
+        name = f'{self.song_id}_{self.difficulty.to_abbreviation()}' if using_difficulty_audio else f'{self.song_id}'
+        measurement = volume_measurements.get(name)
+        # A silent track measures -inf, which cannot be scaled to the target.
+        if measurement is None or measurement['loudness'] is None or not math.isfinite(measurement['loudness']):
+            return volume
+        return max(1, min(100, round(int(volume) * 10 ** ((args.target_loudness - measurement['loudness']) / 20))))
+
     def timing_point(self, timing):
         if timing not in self.events:
             self.events[timing] = {}
@@ -822,21 +1597,19 @@ class Vox:
         parser.source_file_name = os.path.split(path)[-1]
 
         filename_array = os.path.basename(path).split('_')
-        for file in glob(f'{args.db_dir}/*.xml') if args.multi_db else [f'{args.db_dir}/music_db.xml']:
-            with open(file, encoding='cp932') as db:
-                try:
-                    parser.game_id = int(filename_array[0])
-                    parser.song_id = int(filename_array[1])
-                    parser.difficulty = Difficulty.from_letter(os.path.splitext(path)[0][-1])
-                    parser.difficulty_idx = os.path.splitext(path)[0][-2]
-                except ValueError:
-                    raise VoxLoadError(parser.voxfile.name, f'unable to parse difficulty from file name "{path}"')
-
-                tree = ElementTree.fromstring(db.read()).findall('''.//music[@id='{}']'''.format(parser.song_id))
+        for file in music_db_paths():
+            music = music_db_index(file)
+            try:
+                parser.game_id = int(filename_array[0])
+                parser.song_id = int(filename_array[1])
+                parser.difficulty = Difficulty.from_letter(os.path.splitext(path)[0][-1])
+                parser.difficulty_idx = os.path.splitext(path)[0][-2]
+            except ValueError:
+                raise VoxLoadError(parser.voxfile.name, f'unable to parse difficulty from file name "{path}"')
 
-                if len(tree) > 0:
-                    parser.metadata = tree[0]
-                    break
+            if str(parser.song_id) in music:
+                parser.metadata = music[str(parser.song_id)]
+                break
 
         if parser.metadata is None:
             raise VoxLoadError(parser.voxfile.name, f'unable to find metadata for song')
@@ -883,6 +1656,9 @@ class Vox:
             elif self.state is not None:
                 self.process_state(line, section_line_no)
 
+        debug().count('lines_parsed', line_no)
+        debug().count('events', sum(len(e) for e in self.events.values()))
+
         self.finalized = True
 
     def process_state(self, line, section_line_num):
@@ -1116,7 +1892,7 @@ difficulty={self.difficulty.to_ksh_name()}
 level={self.get_metadata('difnum', True)}
 t={self.bpm_string()}
 m={track_basename}
-mvol={self.get_metadata('volume')}
+mvol={self.music_volume(using_difficulty_audio)}
 o=0
 bg={track_bg}
 layer={track_bg}
@@ -1132,255 +1908,26 @@ ver=167'''
 
         print('--', file=file)
 
-        class SpControllerCountdown(dataobject):
-            event: CameraNode
-            time_left: int
-
-        # Below begins the main printing loop.
-        # We iterate through each tick of the song and print a KSH line. If there are events, we put stuff on that line.
-
-        # The currently active BT holds.
-        holds = {}
-
-        # The currently active SpController nodes.
-        ongoing_spcontroller_events = {p: None for p in SpcParam}
-
-        # Whether there is an ongoing laser on either side.
-        lasers = {s: None for s in LaserSide}
-        slam_status = {}
-        last_laser_timing = {s: None for s in LaserSide}
-        last_filter = KshFilter.PEAK
-        current_timesig = self.events[Timing(1, 1, 0)][EventKind.TIMESIG]
         debug().current_line_num = len(header.split('\n')) + 1
 
-        measure_iter = range(self.end.measure)
-
-        for m in measure_iter:
-            measure = m + 1
-
-            now = Timing(measure, 1, 0)
-
-            # Laser range resets every measure in ksh.
-            laser_range = {LaserSide.LEFT: 1, LaserSide.RIGHT: 1}
-
-            if now in self.events and EventKind.TIMESIG in self.events[now]:
-                current_timesig = self.events[now][EventKind.TIMESIG]
-                print(f'beat={current_timesig.top}/{current_timesig.bottom}', file=file)
-
-            for b in range(current_timesig.top):
-                # Vox beats are also 1-indexed.
-                beat = b + 1
-
-                print(f'// #{measure},{beat}', file=file)
-
-                for o in range(int(float(TICKS_PER_BEAT) * (4 / current_timesig.bottom))):
-                    # However, vox offsets are 0-indexed.
-
-                    now = Timing(measure, beat, o)
-
-                    buffer = KshLineBuf()
-
-                    if now in self.events:
-                        for kind, event in self.events[now].items():
-                            if kind == EventKind.TIMESIG and (beat != 1 or o != 0):
-                                raise KshConvertError('time signature change in the middle of a measure')
-
-                            elif kind == EventKind.BPM:
-                                event: float
-                                buffer.meta.append(f't={str(event).rstrip("0").rstrip(".").strip()}')
-
-                            elif kind == EventKind.STOP:
-                                event: int
-                                buffer.meta.append(f'stop={event}')
-
-                            elif type(kind) is tuple and kind[0] == EventKind.SPCONTROLLER:
-                                event: CameraNode
-                                cam_param: SpcParam = kind[1]
-                                if cam_param.to_ksh_value() is not None:
-                                    if ongoing_spcontroller_events[cam_param] is not None and ongoing_spcontroller_events[cam_param].time_left != 0:
-                                        debug().record(Debug.Level.WARNING, 'spnode_output', f'spcontroller node at {now} interrupts another of same kind ({cam_param})')
-                                    ongoing_spcontroller_events[cam_param] = SpControllerCountdown(event=event, time_left=event.duration)
-                                    buffer.meta.append(f'{cam_param.to_ksh_name()}={cam_param.to_ksh_value(event.start_param)}')
-                                elif cam_param.is_state():
-                                    buffer.meta.append(f'{cam_param.to_ksh_name()}={event.duration}')
-
-                            elif kind == EventKind.TILTMODE:
-                                event: TiltMode
-                                buffer.meta.append(f'tilt={event.to_ksh_name()}')
-
-                            elif type(kind) is tuple and kind[0] == EventKind.TRACK:
-                                if kind[1] == 1 or kind[1] == 8:
-                                    # Laser
-                                    if type(event) is LaserSlam:
-                                        event: LaserSlam
-                                        # TODO Laser countdown for different timesigs
-                                        laser = event.start
-
-                                        if event.side in map(lambda x: x.side(), slam_status):
-                                            raise KshConvertError('new laser node spawn while trying to resolve slam')
-
-                                        slam_status[event] = SLAM_TICKS
-
-                                        if laser.roll_kind is not None:
-                                            if buffer.spin != '':
-                                                debug().record(Debug.Level.WARNING, 'ksh_laser', 'spin on both lasers')
-
-                                            if laser.roll_kind.value <= 3:
-                                                buffer.spin = '@'
-                                                if event.direction() == LaserSlam.Direction.LEFT:
-                                                    buffer.spin += '('
-                                                else:
-                                                    buffer.spin += ')'
-
-                                                # My assumption right now is that the MEASURE kind will always take one
-                                                # measure's worth of ticks. Likewise for the other ones.
-                                                if laser.roll_kind == RollKind.MEASURE:
-                                                    buffer.spin += str(int(current_timesig.top * current_timesig.ticks_per_beat() * 0.85))
-                                                elif laser.roll_kind == RollKind.HALF_MEASURE:
-                                                    buffer.spin += str(int((current_timesig.top * current_timesig.ticks_per_beat()) / 2.95))
-                                                elif laser.roll_kind == RollKind.THREE_BEAT:
-                                                    buffer.spin += str(int((current_timesig.top * current_timesig.ticks_per_beat()) * 0.62))
-
-                                            elif laser.roll_kind == RollKind.CANCER:
-                                                # TODO This roll.
-                                                buffer.spin = '@'
-                                                if event.direction() == LaserSlam.Direction.LEFT:
-                                                    buffer.spin += '('
-                                                else:
-                                                    buffer.spin += ')'
-                                                buffer.spin += str(current_timesig.top * current_timesig.ticks_per_beat() * 2)
-                                            elif laser.roll_kind == RollKind.SWING:
-                                                buffer.spin = '@'
-                                                if event.direction() == LaserSlam.Direction.LEFT:
-                                                    buffer.spin += '<'
-                                                else:
-                                                    buffer.spin += '>'
-                                                buffer.spin += str(int((current_timesig.top * current_timesig.ticks_per_beat()) * 0.62))
-
-                                        # noinspection PyUnusedLocal
-                                        event: LaserNode = event.start
-
-                                    event: LaserNode
-
-                                    # KSH defines anything less than a 32th to be a slam, but some vox files
-                                    # have nodes less than a 32th apart from each other. To counter this, we
-                                    # just push laser nodes a tick forward until they're more than a 32th
-                                    # apart.
-                                    skip_laser = False
-                                    thirtysecondth_ticks = int((4 * int(float(TICKS_PER_BEAT) * (4.0 / current_timesig.bottom))) / 32)
-                                    if last_laser_timing[event.side] is not None and now.diff(last_laser_timing[event.side], current_timesig) == thirtysecondth_ticks:
-                                        # Push it a tick forward to avoid being interpreted as a slam.
-                                        if now.add(1, current_timesig) not in self.events:
-                                            self.events[now.add(1, current_timesig)] = {}
-                                        self.events[Timing(now.measure, now.beat, now.offset + 1)][kind] = event
-                                        skip_laser = True
-
-                                        # Look ahead and push other nodes forward.
-                                        no_more_pushes = False
-                                        while not no_more_pushes:
-                                            no_more_pushes = True
-                                            for i in range(6, 1, -1):
-                                                lookahead_timing = now.add(1, current_timesig).add(i, current_timesig)
-                                                if lookahead_timing in self.events and kind in self.events[lookahead_timing]:
-                                                    ev = self.events[lookahead_timing][kind]
-                                                    timing_plus_one = lookahead_timing.add(1, current_timesig)
-                                                    if timing_plus_one not in self.events:
-                                                        self.events[timing_plus_one] = {}
-                                                    self.events[Timing(lookahead_timing.measure, lookahead_timing.beat, lookahead_timing.offset + 1)][kind] = ev
-                                                    del self.events[lookahead_timing][kind]
-                                                    no_more_pushes = False
-
-                                    if event.range != 1:
-                                        buffer.meta.append(f'laserrange_{event.side.to_letter()}={event.range}x')
-                                        laser_range[event.side] = event.range
-
-                                    if event.node_cont != LaserCont.END and event.filter != last_filter:
-                                        if last_filter is None:
-                                            buffer.meta.append(f'pfiltergain={KSH_DEFAULT_FILTER_GAIN}')
-
-                                        if event.filter is None:
-                                            buffer.meta.append(f'pfiltergain=0')
-                                        else:
-                                            buffer.meta.append(f'filtertype={event.filter.to_ksh_name()}')
-
-                                        last_filter = event.filter
-
-                                    if not skip_laser:
-                                        if event.node_cont == LaserCont.START:
-                                            lasers[event.side] = True
-                                        elif event.node_cont == LaserCont.END:
-                                            lasers[event.side] = False
-                                        buffer.lasers[event.side] = event.position_ksh()
-
-                                    last_laser_timing[event.side] = now
-
-                                else:
-                                    # Button
-                                    event: ButtonPress
-                                    if event.duration != 0:
-                                        if event.button.is_fx():
-                                            letter = 'l' if event.button == Button.FX_L else 'r'
-                                            try:
-                                                if type(event.effect) is int:
-                                                    effect_string = self.effect_defines[event.effect].fx_change(event.effect, duration=event.duration) if event.effect >= 0 else self.effect_fallback.fx_change(EFFECT_FALLBACK_NAME)
-                                                else:
-                                                    effect_string = event.effect[0].to_ksh_name(event.effect[1])
-                                                buffer.meta.append(f'fx-{letter}={effect_string}')
-                                            except KeyError:
-                                                debug().record_last_exception(tag='button_fx')
-                                        buffer.buttons[event.button] = KshLineBuf.ButtonState.HOLD
-                                        holds[event.button] = event.duration
-                                    elif args.do_media:
-                                        # Check for a chip sound.
-                                        buffer.buttons[event.button] = KshLineBuf.ButtonState.PRESS
-                                        event.effect: int
-                                        if event.button.is_fx() and event.effect is not None:
-                                            letter = 'l' if event.button == Button.FX_L else 'r'
-                                            buffer.meta.append(f'fx-{letter}_se=fxchip_{event.effect}{FX_CHIP_SOUND_EXTENSION};{FX_CHIP_SOUND_VOL_PERCENT}')
-
-                    # Loop end stuff.
-                    for cam_param in [x for x in ongoing_spcontroller_events.keys() if ongoing_spcontroller_events[x] is not None]:
-                        if ongoing_spcontroller_events[cam_param].time_left == 0 and not cam_param.is_state():
-                            # SpController node ended and there's not another one after.
-                            event: CameraNode = ongoing_spcontroller_events[cam_param].event
-                            buffer.meta.append(f'{cam_param.to_ksh_name()}={cam_param.to_ksh_value(event.end_param)}')
-                            ongoing_spcontroller_events[cam_param] = None
-                        else:
-                            ongoing_spcontroller_events[cam_param].time_left -= 1
-
-                    holds_temp = holds.copy()
-                    for button in holds.keys():
-                        if holds_temp[button] == 0:
-                            del holds_temp[button]
-                        else:
-                            buffer.buttons[button] = KshLineBuf.ButtonState.HOLD
-                            holds_temp[button] -= 1
-                    holds = holds_temp
-
-                    for side in LaserSide:
-                        if buffer.lasers[side] == '-' and lasers[side]:
-                            buffer.lasers[side] = ':'
-
-                    for slam in reversed(list(slam_status.keys())):
-                        if slam_status[slam] == 0:
-                            buffer.lasers[slam.side()] = slam.end.position_ksh()
-                            del slam_status[slam]
-                            if slam.end.node_cont == LaserCont.END:
-                                lasers[slam.side()] = False
-                        else:
-                            if slam_status[slam] < SLAM_TICKS:
-                                buffer.lasers[slam.side()] = ':'
-                            slam_status[slam] -= 1
-
-                    out = buffer.out()
-
-                    print(out, file=file)
-
-                    debug().current_line_num += len(out.split('\n'))
-
-            print('--', file=file)
-
-            debug().current_line_num += 1
+        split = args.split_chart_measures
+        if measure_pool is not None and split and self.end.measure > split:
+            # Work out the state at the start of each range of measures, and write the ranges in other processes.
+            writer = KshWriter(self, True, args.do_media)
+            writer.index_timings()
+            ranges = []
+            for measure in range(1, self.end.measure + 1, split):
+                end_measure = min(measure + split, self.end.measure + 1)
+                ranges.append(measure_pool.submit(write_measure_range, writer.copy_from(measure, end_measure),
+                                                  measure, end_measure))
+                for m in range(measure, end_measure):
+                    writer.skip_measure(m)
+            for future in ranges:
+                file.write(future.result())
+        else:
+            writer = KshWriter(self, args.render_grid, args.do_media)
+            for m in range(self.end.measure):
+                writer.write_measure(m + 1, file)
 
         for k, v in self.effect_defines.items():
             print(v.define_line(k), file=file)
@@ -1446,37 +1993,55 @@ CASES = {
     'laser-centering': (1244, 'm')
 }
 
-thread_id_index = {}
 def thread_print(line):
-    if threading.get_ident() not in thread_id_index:
-        thread_id_index[threading.get_ident()] = len(thread_id_index) + 1
-    print(f'{thread_id_index[threading.get_ident()]}> {line}')
+    run_log.message(line)
 
-def do_process_voxfiles(files):
+def do_process_voxfiles(files, force=False):
+    """ Convert each of the vox files. With `force`, charts are converted even if the journal says they are done. """
     global args
 
     # Load source directory.
     for vox_path in files:
+        if stopping.is_set():
+            break
+        # Futures for the media copies of this chart.
+        media = []
+        vox = None
+        reserved = 0
         try:
             debug().state = Debug.State.INPUT
             debug().input_filename = vox_path
             debug().output_filename = None
             debug().reset()
 
+            if chart_budget is not None:
+                with debug().phase('memory_wait'):
+                    reserved = chart_budget.acquire(os.path.getsize(vox_path) * VOX_MEMORY_FACTOR)
+
             # noinspection PyBroadException
             try:
-                vox = Vox.from_file(vox_path)
+                with debug().phase('metadata'):
+                    vox = Vox.from_file(vox_path)
             except Exception:
                 debug().record_last_exception(level=Debug.Level.ERROR, tag='vox_load')
                 continue
 
             thread_print(f'Processing "{vox_path}": {str(vox)}')
 
+            if journal is not None and args.do_convert and not force and \
+                    journal.is_done(vox_path, f'out/{vox.ascii}/chart_{vox.diff_abbreviation()}.ksh'):
+                thread_print(f'Skipping "{vox_path}", it was converted by the previous run.')
+                debug().count('charts_resumed')
+                vox.close()
+                continue
+
             start_time = time.time()
+            profiler = ChartProfiler.from_args(vox_path)
 
             # First try to parse the file.
             try:
-                vox.parse()
+                with debug().phase('parse'), profiler.run():
+                    vox.parse()
             except Exception as e:
                 thread_print(f'Parsing vox file failed with "{str(e)}":\n{traceback.format_exc()}')
                 debug().record_last_exception(level=Debug.Level.ERROR, tag='vox_parse', trace=True)
@@ -1486,19 +2051,20 @@ def do_process_voxfiles(files):
             song_dir = f'out/{vox.ascii}'
             if not os.path.isdir(song_dir):
                 thread_print(f'Creating song directory "{song_dir}".')
-                os.mkdir(song_dir)
+                os.makedirs(song_dir, exist_ok=True)
 
             jacket_idx = None
             using_difficulty_audio = None
 
-            # Copy media files over.
+            # Copy media files over. With an I/O pool the copies go on while the chart is written.
             if args.do_media:
-                using_difficulty_audio = do_copy_audio(vox, song_dir)
-                jacket_idx = do_copy_jacket(vox, song_dir)
+                with debug().phase('media'):
+                    using_difficulty_audio = do_copy_audio(vox, song_dir, media)
+                    jacket_idx = do_copy_jacket(vox, song_dir, media)
 
-                # Copy FX chip sounds.
-                if len(vox.required_chip_sounds) > 0:
-                    do_copy_fx_chip_sounds(vox, song_dir)
+                    # Copy FX chip sounds.
+                    if len(vox.required_chip_sounds) > 0:
+                        do_copy_fx_chip_sounds(vox, song_dir, media)
 
             # Output the KSH chart.
             chart_path = f'{song_dir}/chart_{vox.diff_abbreviation()}.ksh'
@@ -1508,28 +2074,120 @@ def do_process_voxfiles(files):
 
             if args.do_convert:
                 thread_print(f'Writing KSH data to "{chart_path}".')
-                with open(chart_path, "w+", encoding='utf-8') as ksh_file:
-                    try:
-                        vox.write_to_ksh(jacket_idx=jacket_idx,
-                                         using_difficulty_audio=using_difficulty_audio,
-                                         file=ksh_file)
-                    except Exception as e:
-                        print(f'Outputting to ksh failed with "{str(e)}"\n{traceback.format_exc()}\n')
-                        debug().record_last_exception(level=Debug.Level.ERROR, tag='ksh_output', trace=True)
-                        continue
-                    duration = time.time() - start_time
-                    if debug().has_issues():
-                        exceptions = debug().exceptions_count
-                        thread_print(f'Finished conversion in {truncate(duration, 4)}s with {exceptions[Debug.Level.ABNORMALITY]} abnormalities, {exceptions[Debug.Level.WARNING]} warnings, and {exceptions[Debug.Level.ERROR]} errors.')
-                    else:
-                        thread_print(f'Finished conversion in {truncate(duration, 4)}s with no issues.')
+                # The chart is written under a temporary name and renamed once complete, so a chart that failed or was
+                #  cut off never replaces a good one.
+                temp_chart_path = make_temp_file(chart_path)
+                try:
+                    with open(temp_chart_path, "w+", encoding='utf-8') as ksh_file:
+                        with debug().phase('write'), profiler.run():
+                            vox.write_to_ksh(jacket_idx=jacket_idx,
+                                             using_difficulty_audio=using_difficulty_audio,
+                                             file=ksh_file)
+                        debug().count('bytes_written', ksh_file.tell())
+                    os.replace(temp_chart_path, chart_path)
+                except Exception as e:
+                    thread_print(f'Outputting to ksh failed with "{str(e)}"\n{traceback.format_exc()}')
+                    debug().record_last_exception(level=Debug.Level.ERROR, tag='ksh_output', trace=True)
+                    continue
+                finally:
+                    if os.path.exists(temp_chart_path):
+                        os.remove(temp_chart_path)
+                if not wait_for_media(media):
+                    thread_print(f'Copying media files for "{vox_path}" failed.')
+                    continue
+                if journal is not None:
+                    journal.record(vox_path, chart_path)
+                duration = time.time() - start_time
+                if debug().has_issues():
+                    exceptions = debug().exceptions_count
+                    thread_print(f'Finished conversion in {truncate(duration, 4)}s with {exceptions[Debug.Level.ABNORMALITY]} abnormalities, {exceptions[Debug.Level.WARNING]} warnings, and {exceptions[Debug.Level.ERROR]} errors.')
+                else:
+                    thread_print(f'Finished conversion in {truncate(duration, 4)}s with no issues.')
             else:
                 thread_print(f'Skipping conversion step.')
+            if profiler.dump():
+                thread_print(f'Wrote profiling data for "{vox_path}" to the debug directory.')
             vox.close()
         except Exception as e:
             debug().record_last_exception(Debug.Level.ERROR, 'other', f'an error occurred: {str(e)}')
+        finally:
+            # Copies still going when the chart failed are recorded against it too.
+            wait_for_media(media)
+            debug().finish_chart()
+            # Let go of the chart before the next one can be loaded in its place.
+            vox = None
+            if chart_budget is not None:
+                chart_budget.release(reserved)
+
+def copy_media(src_path, target_path, media):
+    """
+    Copy a media file to the output directory. With an I/O pool, the copy is started in the background and its future
+    added to `media`. Each file is only copied once per run, so charts of the same song wait on the same copy.
+    """
+    with media_copies_lock:
+        media_sources[target_path] = src_path
+
+    if io_pool is None:
+        copy_file(src_path, target_path)
+        return
 
-def do_copy_audio(vox, out_dir):
+    with media_copies_lock:
+        if target_path in media_copies:
+            media.append(media_copies[target_path])
+            return
+
+    # Wait for room without holding the lock, then check again in case another chart started the same copy meanwhile.
+    reserved = media_budget.acquire(os.path.getsize(src_path)) if media_budget is not None else 0
+    with media_copies_lock:
+        if target_path in media_copies:
+            future = media_copies[target_path]
+            if media_budget is not None:
+                media_budget.release(reserved)
+        else:
+            future = io_pool.submit(copy_file, src_path, target_path)
+            if media_budget is not None:
+                future.add_done_callback(lambda _: media_budget.release(reserved))
+            media_copies[target_path] = future
+        media.append(future)
+
+def make_temp_file(path):
+    """
+    Create an empty file to write `path` under before renaming it. The name is unique, so several threads writing the
+    same file never write over each other's temporary file.
+    :return: The path of the temporary file.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f'{os.path.basename(path)}.',
+                                         suffix='.tmp')
+    os.close(handle)
+    os.chmod(temp_path, 0o666 & ~UMASK)
+    return temp_path
+
+def copy_file(src_path, target_path):
+    """ Copy through a temporary file, so a half-copied file is never left under the target name. """
+    temp_path = make_temp_file(target_path)
+    try:
+        shutil.copyfile(src_path, temp_path)
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def wait_for_media(media):
+    """
+    Wait for the media copies of the current chart, recording the ones that failed.
+    :return: True if every copy succeeded.
+    """
+    succeeded = True
+    with debug().phase('media'):
+        while len(media) > 0:
+            try:
+                media.pop(0).result()
+            except Exception:
+                debug().record_last_exception(level=Debug.Level.ERROR, tag='copy_media')
+                succeeded = False
+    return succeeded
+
+def do_copy_audio(vox, out_dir, media):
     """
     Search for and copy the track's audio file to the output directory.
     :return: True if the audio file is difficulty-specific, otherwise False.
@@ -1554,13 +2212,13 @@ def do_copy_audio(vox, out_dir):
 
     if not os.path.exists(target_audio_path):
         thread_print(f'Copying audio file "{src_audio_path}" to song directory.')
-        shutil.copyfile(src_audio_path, target_audio_path)
+        copy_media(src_audio_path, target_audio_path, media)
     else:
         thread_print(f'Audio file "{target_audio_path}" already exists.')
 
     return using_difficulty_audio
 
-def do_copy_jacket(vox, out_dir):
+def do_copy_jacket(vox, out_dir, media):
     """
     Find and copy the jacket image file for this vox to the output directory.
     :return: The index of the jacket used by this vox.
@@ -1572,7 +2230,7 @@ def do_copy_jacket(vox, out_dir):
     if os.path.exists(src_jacket_path):
         target_jacket_path = f'{out_dir}/jacket_{str(vox.difficulty.to_jacket_ifs_numer())}.png'
         thread_print(f'Jacket image file found at "{src_jacket_path}". Copying to "{target_jacket_path}".')
-        shutil.copyfile(src_jacket_path, target_jacket_path)
+        copy_media(src_jacket_path, target_jacket_path, media)
     else:
         thread_print(f'Could not find jacket image file. Checking easier diffs.')
         fallback_jacket_diff_idx = vox.difficulty.to_jacket_ifs_numer() - 1
@@ -1588,13 +2246,13 @@ def do_copy_jacket(vox, out_dir):
             if os.path.exists(easier_jacket_path):
                 # We found the diff number with the jacket.
                 thread_print(f'Using jacket "{easier_jacket_path}".')
-                shutil.copyfile(easier_jacket_path, target_jacket_path)
+                copy_media(easier_jacket_path, target_jacket_path, media)
                 return fallback_jacket_diff_idx
             fallback_jacket_diff_idx -= 1
 
     return vox.difficulty.to_jacket_ifs_numer()
 
-def do_copy_preview(vox, out_dir):
+def do_copy_preview(vox, out_dir, media):
     """
     Find and copy the preview for this vox to the output directory.
     :return: True if this chart has a difficulty-specific preview file, False otherwise.
@@ -1617,15 +2275,15 @@ def do_copy_preview(vox, out_dir):
 
     if os.path.exists(preview_path):
         thread_print(f'Copying preview to "{output_path}".')
-        shutil.copyfile(preview_path, output_path)
+        copy_media(preview_path, output_path, media)
     else:
-        print('> No preview file found.')
+        thread_print('No preview file found.')
         debug().record(Debug.Level.WARNING, 'preview_copy', 'could not find preview file')
         return None
 
     return using_difficulty_preview
 
-def do_copy_fx_chip_sounds(vox, out_dir):
+def do_copy_fx_chip_sounds(vox, out_dir, media):
     """ For each FX chip sound used in the chart, copy the sound file to the output directory. """
     global args
 
@@ -1634,16 +2292,118 @@ def do_copy_fx_chip_sounds(vox, out_dir):
         src_path = f'{args.fx_chip_sound_dir}/{sound}{FX_CHIP_SOUND_EXTENSION}'
         target_path = f'{out_dir}/fxchip_{sound}{FX_CHIP_SOUND_EXTENSION}'
         if os.path.exists(src_path):
-            shutil.copyfile(src_path, target_path)
+            copy_media(src_path, target_path, media)
         else:
             debug().record(Debug.Level.ERROR, 'copy_fx_chip_sound', f'cannot find file for chip sound with id {sound}')
-            shutil.copyfile(f'{args.fx_chip_sound_dir}/0{FX_CHIP_SOUND_EXTENSION}', target_path)
+            copy_media(f'{args.fx_chip_sound_dir}/0{FX_CHIP_SOUND_EXTENSION}', target_path, media)
+
+def music_db_index(path):
+    """
+    :return: The "music" elements of a music DB file by song ID. Each file is parsed once and kept until it changes, so
+    loading a chart does not parse the whole DB again.
+    """
+    stat = os.stat(path)
+    fingerprint = (stat.st_size, stat.st_mtime_ns)
+    with music_dbs_lock:
+        if path not in music_dbs or music_dbs[path][0] != fingerprint:
+            with open(path, encoding='cp932') as db:
+                root = ElementTree.fromstring(db.read())
+            music = {}
+            for element in root.iterfind('.//music'):
+                # The first entry for a song wins, like a search of the file would find.
+                music.setdefault(element.get('id'), element)
+            music_dbs[path] = (fingerprint, music)
+        return music_dbs[path][1]
+
+def music_db_paths():
+    return glob(f'{args.db_dir}/*.xml') if args.multi_db else [f'{args.db_dir}/music_db.xml']
+
+def load_music_dbs():
+    """ Load every music DB up front, for modes that keep running. """
+    for path in music_db_paths():
+        if os.path.exists(path):
+            music_db_index(path)
+
+def convert_chart(vox_path):
+    """
+    Convert a single chart for --serve. The chart is always converted, since the journal does not know about changes to
+    its music DB entry or media files.
+    :return: The chart's report, with its timings, counters and issue counts.
+    """
+    with conversion_locks_lock:
+        lock = conversion_locks.setdefault(os.path.realpath(vox_path), threading.Lock())
+    # Requests for the same chart are converted one at a time, since they write the same files.
+    with lock:
+        do_process_voxfiles([vox_path], force=True)
+        return dict(debug().chart_reports[-1])
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the --serve HTTP server. POST /convert with a JSON object {"vox": path} converts a chart and
+    returns its report, where the path can also be a file name in the vox directory. GET /status checks that the server
+    is up.
+    """
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_json(404, {'error': f'no such endpoint "{self.path}"'})
+            return
+        with music_dbs_lock:
+            cached = sorted(music_dbs.keys())
+        self.send_json(200, {'status': 'ok', 'music_dbs': cached})
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self.send_json(404, {'error': f'no such endpoint "{self.path}"'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            vox_path = request['vox']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'expected a JSON object with a "vox" path'})
+            return
+        if not os.path.isfile(vox_path):
+            vox_path = os.path.join(args.vox_dir, vox_path)
+        if not os.path.isfile(vox_path):
+            self.send_json(404, {'error': f'no vox file "{request["vox"]}"'})
+            return
+
+        start = time.perf_counter()
+        report = conversion_pool.submit(convert_chart, vox_path).result()
+        report['status'] = 'ok' if report['issues'][Debug.Level.ERROR.value] == 0 else 'failed'
+        report['elapsed'] = time.perf_counter() - start
+        self.send_json(200, report)
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *values):
+        run_log.emit('http', format % values)
+
+def serve(port):
+    """ Convert charts as they are requested over HTTP on the loopback interface, until interrupted. """
+    global conversion_pool
+    load_music_dbs()
+    conversion_pool = ThreadPoolExecutor(max_workers=args.num_cores, thread_name_prefix='convert')
+    server = ThreadingHTTPServer(('127.0.0.1', port), ConversionRequestHandler)
+    thread_print(f'Waiting for conversion requests on http://127.0.0.1:{port}/convert.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        conversion_pool.shutdown()
 
 def debug():
     global debugs
 
     if threading.get_ident() not in debugs:
-        debugs[threading.get_ident()] = Debug(f'debug/exceptions_{threading.get_ident()}.txt')
+        debugs[threading.get_ident()] = Debug()
     return debugs[threading.get_ident()]
 
 ##############
@@ -1652,8 +2412,323 @@ def debug():
 
 args = None
 debugs = {}
+volume_measurements = {}
+# Writes measure ranges of long charts, when --split-chart-measures is given.
+measure_pool = None
+# Copies media files, when --io-threads is above 0.
+io_pool = None
+# The copy of each media file, by target path.
+media_copies = {}
+media_copies_lock = threading.Lock()
+# Limit the memory held by parsed charts and by media copies in progress, when --memory-budget or --media-budget is
+#  given.
+chart_budget = None
+media_budget = None
+# The charts finished so far, for --resume.
+journal = None
+# The source of every media file copied so far, by target path, for --watch.
+media_sources = {}
+# Parsed music DBs by path, as ((size, modification time), {song ID: music element}).
+music_dbs = {}
+music_dbs_lock = threading.Lock()
+# Runs the conversions requested from --serve.
+conversion_pool = None
+# Set to make the worker threads stop before their next chart.
+stopping = threading.Event()
+# A lock for each vox file converted by --serve.
+conversion_locks = {}
+conversion_locks_lock = threading.Lock()
 config = configparser.ConfigParser()
 
+def parse_shard(value):
+    """ Parse a --shard argument given as INDEX/COUNT, with INDEX counted from 1. """
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'"{value}" is not in the form INDEX/COUNT')
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'shard index {index} is not between 1 and {count}')
+    return index, count
+
+def in_shard(key):
+    """
+    :param key: The song ID, or the file name for charts without one.
+    :return: True if the chart belongs to the shard given with --shard. Every machine assigns a song to the same shard,
+    and all difficulties of a song go to the same one.
+    """
+    if args.shard is None:
+        return True
+    index, count = args.shard
+    return zlib.crc32(key.encode('utf-8')) % count == index - 1
+
+def find_vox_files():
+    """
+    List the vox directory once and pick out the charts matching the song, testcase, difficulty and shard filters.
+    Chart file names look like "<game>_<song ID>_<name>_<difficulty>.vox". When the same chart is in several games, only
+    the file from the newest game is kept.
+    :return: The paths of the charts to convert, sorted.
+    """
+    song_id = None if args.song_id is None else args.song_id.zfill(4)
+    testcase = CASES[args.testcase] if args.testcase is not None else None
+
+    # The newest file for each song and difficulty, as (game, path).
+    charts = {}
+    malformed = []
+    with os.scandir(args.vox_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.endswith('.vox') or name.startswith('.'):
+                continue
+            stem = splitx(name)[0]
+            difficulty = stem[-1]
+            if args.song_difficulty is not None and difficulty != args.song_difficulty:
+                continue
+
+            path = os.path.join(args.vox_dir, name)
+            fields = stem.split('_')
+            try:
+                game, song = int(fields[0]), int(fields[1])
+            except (IndexError, ValueError):
+                # Malformed file name. There is nothing to match the filters against, so it is only converted when
+                #  converting everything.
+                if song_id is None and testcase is None and in_shard(name):
+                    malformed.append(path)
+                continue
+
+            if song_id is not None and fields[1] != song_id:
+                continue
+            if testcase is not None and not (1 <= game <= 4 and song == testcase[0] and difficulty == testcase[1]):
+                continue
+            if not in_shard(str(song)):
+                continue
+
+            key = (song, difficulty)
+            if key not in charts or charts[key][0] < game:
+                charts[key] = (game, path)
+
+    return sorted([path for _, path in charts.values()] + malformed)
+
+def convert(candidates, force=False):
+    """ Convert the charts, spread across the worker threads so that the charts of a song are all on the same one. """
+    groups = [[] for _ in range(args.num_cores)]
+    for i, candidate in enumerate(candidates):
+        try:
+            song_id = os.path.basename(candidate).split('_')[1]
+            groups[int(song_id) % args.num_cores].append(candidate)
+        except (ValueError, IndexError):
+            groups[i % args.num_cores].append(candidate)
+
+    threads = []
+
+    for i in range(args.num_cores):
+        thread = threading.Thread(target=do_process_voxfiles, args=(groups[i], force), name=f'{i + 1}')
+        threads.append(thread)
+
+    print(f'Performing conversion across {args.num_cores} threads.')
+
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        # Let the workers finish their current chart, so nothing is left half-written or using the journal and pools
+        #  after they are closed.
+        print('Stopping once the charts being converted are finished.')
+        stopping.set()
+        for t in threads:
+            t.join()
+        stopping.clear()
+        raise
+
+class DirectoryWatcher:
+    """
+    Reports the files created or changed in a set of directories. Uses inotify if inotify_simple is installed, and
+    otherwise compares listings of the directories every `interval` seconds. Deleted files are not reported.
+    """
+    def __init__(self, directories, interval):
+        self.directories = []
+        for directory in directories:
+            # The same directory can be passed for several purposes, or spelled differently.
+            if os.path.isdir(directory) and \
+                    all(not os.path.samefile(directory, d) for d in self.directories):
+                self.directories.append(directory)
+        self.interval = interval
+        if INotify is not None:
+            self.inotify = INotify()
+            self.watches = {self.inotify.add_watch(d, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO): d
+                            for d in self.directories}
+        else:
+            self.inotify = None
+            self.listings = {d: self._list(d) for d in self.directories}
+
+    @staticmethod
+    def _list(directory):
+        """ :return: The size and modification time of every file in the directory, by name. """
+        listing = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return listing
+
+    def _poll(self):
+        """ :return: The files changed since the last call as (directory, name), waiting up to `interval` seconds. """
+        if self.inotify is not None:
+            events = self.inotify.read(timeout=int(self.interval * 1000))
+            return {(self.watches[event.wd], event.name) for event in events}
+        time.sleep(self.interval)
+        changed = set()
+        for directory in self.directories:
+            listing = self._list(directory)
+            changed.update((directory, name) for name, stat in listing.items()
+                           if self.listings[directory].get(name) != stat)
+            self.listings[directory] = listing
+        return changed
+
+    def wait(self):
+        """
+        Wait for files to change, and then for them to stop changing for `interval` seconds, so a file that is still
+        being written or a batch of files being copied in is handled once.
+        :return: The changed files as (directory, name).
+        """
+        changed = set()
+        while len(changed) == 0:
+            changed = self._poll()
+        while True:
+            more = self._poll()
+            if len(more) == 0:
+                return changed
+            changed |= more
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+def changed_songs(db_path):
+    """
+    Reload a music DB.
+    :return: The IDs of the songs whose entries were added or changed since it was last loaded.
+    """
+    with music_dbs_lock:
+        old = music_dbs[db_path][1] if db_path in music_dbs else {}
+    new = music_db_index(db_path)
+    return {song for song, music in new.items()
+            if song not in old or ElementTree.tostring(old[song]) != ElementTree.tostring(music)}
+
+def same_directory(directory, other):
+    return os.path.realpath(directory) == os.path.realpath(other)
+
+def song_dirs(charts):
+    """ :return: The output directories of the charts. """
+    directories = set()
+    for chart in charts:
+        # noinspection PyBroadException
+        try:
+            vox = Vox.from_file(chart)
+        except Exception:
+            # The error is recorded when the chart is converted.
+            continue
+        directories.add(f'out/{vox.ascii}')
+        vox.close()
+    return directories
+
+def media_target(directory, name, song_dir):
+    """
+    :return: Where an audio file or jacket is copied to in a song's output directory, following the names used by
+    do_copy_audio and do_copy_jacket, or None if it is neither.
+    """
+    stem, extension = splitx(name)
+    fields = stem.split('_')
+    if same_directory(directory, args.audio_dir) and extension == AUDIO_EXTENSION:
+        return f'{song_dir}/track{extension}' if len(fields) == 1 else f'{song_dir}/track_{fields[1]}{extension}'
+    if same_directory(directory, args.jacket_dir) and extension == '.png' and len(fields) == 2:
+        return f'{song_dir}/jacket_{fields[1]}{extension}'
+    return None
+
+def charts_affected_by(changed):
+    """
+    Work out what to do about files that changed in the source directories. Media files that were already copied are
+    copied again straight away.
+    :return: The charts to convert again: changed vox files, and every chart of a song whose music DB entry changed or
+    that has a new audio file or jacket.
+    """
+    candidates = find_vox_files()
+    songs = {}
+    for candidate in candidates:
+        try:
+            songs.setdefault(str(int(os.path.basename(candidate).split('_')[1])), []).append(candidate)
+        except (ValueError, IndexError):
+            pass
+
+    affected = set()
+    for directory, name in sorted(changed):
+        if same_directory(directory, args.vox_dir):
+            # Build the path the way find_vox_files does.
+            path = os.path.join(args.vox_dir, name)
+            if path in candidates:
+                affected.add(path)
+        if same_directory(directory, args.db_dir):
+            path = os.path.join(args.db_dir, name)
+            if any(same_directory(path, db_path) for db_path in music_db_paths()) and os.path.exists(path):
+                for song in changed_songs(path):
+                    affected.update(songs.get(song, []))
+        if not args.do_media:
+            continue
+
+        path = os.path.join(directory, name)
+        song = splitx(name)[0].split('_')[0]
+        is_chip_sound = same_directory(directory, args.fx_chip_sound_dir)
+        if is_chip_sound:
+            targets = set(glob(f'out/*/fxchip_{name}'))
+        else:
+            targets = {media_target(directory, name, song_dir) for song_dir in song_dirs(songs.get(song, []))}
+            targets.discard(None)
+        with media_copies_lock:
+            # Charts using a chip sound that was missing got a copy of the default one, which has to follow it.
+            real_path = os.path.realpath(path)
+            targets.update(t for t, source in media_sources.items() if os.path.realpath(source) == real_path)
+            copied = {t for t in targets if os.path.exists(t)}
+            for target in copied:
+                media_sources[target] = path
+                # Later copies of the target in this run would otherwise reuse the earlier one.
+                media_copies.pop(target, None)
+        for target in sorted(copied):
+            thread_print(f'Copying "{path}" to "{target}".')
+            try:
+                copy_file(path, target)
+            except OSError as e:
+                thread_print(f'Copying "{path}" failed with "{str(e)}".')
+        if copied != targets and not is_chip_sound:
+            # A new audio file or jacket can change which files the song's charts use.
+            affected.update(songs.get(song, []))
+    return sorted(affected)
+
+def watch():
+    """ Convert the charts affected by changes to the source directories again, until interrupted. """
+    # Changes to the music DBs are told apart from what was converted by comparing with the loaded copies.
+    load_music_dbs()
+
+    directories = [args.vox_dir, args.db_dir]
+    if args.do_media:
+        directories += [args.audio_dir, args.jacket_dir, args.fx_chip_sound_dir]
+    watcher = DirectoryWatcher(directories, args.watch_interval)
+    method = 'inotify' if INotify is not None else f'polling every {args.watch_interval}s'
+    print(f'Watching {", ".join(watcher.directories)} for changes ({method}).')
+    try:
+        while True:
+            charts = charts_affected_by(watcher.wait())
+            if len(charts) > 0:
+                print('The following files changed or are affected by changes:')
+                for f in charts:
+                    print(f'\t{f}')
+                convert(charts, force=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
 def main():
     global config
     if not os.path.exists('config.ini'):
@@ -1677,6 +2752,47 @@ def main():
     argparser.add_argument('-P', '--preview-dir', default='D:/SDVX-Extract/preview')
     argparser.add_argument('-c', '--clean-output', action='store_true', dest='do_clean_output')
     argparser.add_argument('-e', '--clean-debug', action='store_true', dest='do_clean_debug')
+    argparser.add_argument('--target-loudness', type=float, metavar='LUFS',
+                           help='Scale each chart\'s music volume so its audio plays at this integrated loudness, using '
+                                'the measurements prepare_audio stores in the audio directory.')
+    argparser.add_argument('--render-grid', action='store_true',
+                           help='Render the notes of each measure in a grid and write the measure at once, instead of '
+                                'building every line separately.')
+    argparser.add_argument('--io-threads', type=int, default=4, metavar='THREADS',
+                           help='Copy media files on this many threads while charts are being written. With 0, each '
+                                'chart\'s media is copied before its chart is written.')
+    argparser.add_argument('--serve', type=int, metavar='PORT',
+                           help='Instead of converting the vox directory, keep running and convert the charts '
+                                'requested over HTTP on this port of 127.0.0.1. The music DB stays loaded between '
+                                'requests.')
+    argparser.add_argument('--watch', action='store_true',
+                           help='After converting, keep watching the vox, DB and media directories and convert the '
+                                'charts affected by changes again.')
+    argparser.add_argument('--watch-interval', type=float, default=1.0, metavar='SECONDS',
+                           help='How long changes must settle before they are handled by --watch, and how often the '
+                                'directories are checked when inotify_simple is not installed.')
+    argparser.add_argument('--shard', type=parse_shard, metavar='INDEX/COUNT',
+                           help='Only convert the songs in this shard out of COUNT, to split a conversion between '
+                                'machines. Combine the run reports of every shard with merge_reports.py.')
+    argparser.add_argument('-r', '--resume', action='store_true',
+                           help='Skip the charts that the previous run finished and that have not changed since.')
+    argparser.add_argument('--memory-budget', type=int, default=0, metavar='MB',
+                           help='Hold at most about this many megabytes of parsed charts at once, across all worker '
+                                'threads. Each chart is estimated from the size of its vox file.')
+    argparser.add_argument('--media-budget', type=int, default=0, metavar='MB',
+                           help='Have at most this many megabytes of media files being copied at once.')
+    argparser.add_argument('--split-chart-measures', type=int, default=0, metavar='MEASURES',
+                           help='Write charts longer than this many measures in ranges of this many measures, spread '
+                                'across a pool of processes.')
+    argparser.add_argument('--profile', action='store_true',
+                           help='Run each chart\'s parse and write steps under cProfile and save the stats to the '
+                                'debug directory. Only one chart is profiled at a time, so worker threads take turns '
+                                'parsing and writing.')
+    argparser.add_argument('--trace-malloc', action='store_true',
+                           help='Trace memory allocations with tracemalloc and save the top allocations of each chart '
+                                'to the debug directory. Allocations from other threads are included when -j > 1.')
+    argparser.add_argument('--profile-threshold', type=float, default=0, metavar='MS',
+                           help='Only save profiling data for charts whose parse and write took at least this long.')
     args = argparser.parse_args()
 
     if args.testcase:
@@ -1687,6 +2803,14 @@ def main():
                 print('\t' + c, file=sys.stderr)
             exit(1)
 
+    if args.serve is not None and args.watch:
+        print('--serve cannot be used with --watch', file=sys.stderr)
+        exit(1)
+
+    if args.resume and args.do_clean_output:
+        print('--resume cannot be used with --clean-output', file=sys.stderr)
+        exit(1)
+
     # Create output directory.
     if args.do_clean_output:
         print('Cleaning directory of old charts.')
@@ -1702,60 +2826,64 @@ def main():
         print(f'Creating debug output directory.')
         os.mkdir('debug')
 
-    candidates = []
-
-    print(f'Finding vox files.')
-
-    for filename in glob(f'{args.vox_dir}/*.vox'):
-        import re
-        if (args.song_id is None and args.testcase is None) or \
-                (args.song_id is not None and f'_{args.song_id.zfill(4)}_' in filename) or \
-                (args.testcase is not None and re.match(rf'^.*00[1-4]_0*{CASES[args.testcase][0]}_.*{CASES[args.testcase][1]}\.vox$', filename)):
-            if args.song_difficulty is None or splitx(filename)[0][-1] == args.song_difficulty:
-                # See if this is overriding an earlier game's version of the chart.
-                try:
-                    prev: str = next(filter(lambda n: n.split('_')[1] == filename.split('_')[1] and splitx(n)[0][-1] == splitx(filename)[0][-1], candidates))
-                    if int(prev.split('_')[1]) < int(filename.split('_')[1]):
-                        candidates.remove(prev)
-                    else:
-                        continue
-                except StopIteration:
-                    # Not clashing with anything.
-                    pass
-                except (IndexError, ValueError):
-                    # Malformed file name.
-                    pass
-
-                candidates.append(filename)
-
-    print('The following files will be processed:')
-    for f in candidates:
-        print(f'\t{f}')
-
-    groups = [[] for _ in range(args.num_cores)]
-    for i, candidate in enumerate(candidates):
-        try:
-            song_id = os.path.basename(candidate).split('_')[1]
-            groups[int(song_id) % args.num_cores].append(candidate)
-        except (ValueError, IndexError):
-            groups[i % args.num_cores].append(candidate)
-
-    threads = []
-
-    global debugs
-
-    for i in range(args.num_cores):
-        thread = threading.Thread(target=do_process_voxfiles, args=(groups[i],), name=f'Thread-{i}')
-        threads.append(thread)
-
-    print(f'Performing conversion across {args.num_cores} threads.')
-
-    for t in threads:
-        t.start()
-    for t in threads:
-        t.join()
-    for d in debugs.values():
-        d.close()
+    if args.trace_malloc:
+        tracemalloc.start()
+
+    global volume_measurements
+    volume_table_path = f'{args.audio_dir}/{volume_table.TABLE_FILENAME}'
+    if args.target_loudness is not None and os.path.exists(volume_table_path):
+        volume_measurements = volume_table.load(volume_table_path)
+
+    global journal
+    journal = conversion_journal.ConversionJournal(f'out/{conversion_journal.JOURNAL_FILENAME}', args.resume)
+
+    global io_pool
+    if args.do_media and args.io_threads > 0:
+        io_pool = ThreadPoolExecutor(max_workers=args.io_threads, thread_name_prefix='io')
+
+    # Workers wait for room in these budgets before loading a chart or starting a copy.
+    global chart_budget, media_budget
+    if args.memory_budget > 0:
+        chart_budget = MemoryBudget(args.memory_budget * 1024 * 1024)
+    if args.media_budget > 0:
+        media_budget = MemoryBudget(args.media_budget * 1024 * 1024)
+
+    global measure_pool
+    if args.split_chart_measures > 0:
+        # Issues are recorded while working out the state at the start of each range, so it does not matter that the
+        #  workers have no run log. They are spawned rather than forked, since forking while the other threads are
+        #  running can deadlock.
+        measure_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+
+    log = run_log.RunLog('debug/log.jsonl')
+    log.start()
+    if args.serve is not None:
+        serve(args.serve)
+    else:
+        print(f'Finding vox files.')
+        candidates = find_vox_files()
+
+        print('The following files will be processed:')
+        for f in candidates:
+            print(f'\t{f}')
+
+        convert(candidates)
+        if args.watch:
+            watch()
+
+    if io_pool is not None:
+        io_pool.shutdown()
+    if measure_pool is not None:
+        measure_pool.shutdown()
+    log.stop()
+    journal.close()
+
+    report = Debug.run_report(debugs.values())
+    report['shard'] = {'index': args.shard[0], 'count': args.shard[1]} if args.shard is not None else None
+    report['manifest'] = journal.manifest()
+    run_report.print_report(report)
+    with open('debug/run_report.json', 'w') as report_file:
+        json.dump(report, report_file, indent=4)
 
 if __name__ == '__main__':
     main()
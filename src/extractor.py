@@ -1,10 +1,30 @@
 #!/usr/bin/env python3
 import xml.etree.ElementTree as ET
-import glob
+import argparse
+import json
 import re
 import os, subprocess
 import configparser
-from shutil import copyfile, rmtree
+import sqlite3
+import tempfile
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from shutil import copyfile
+
+import twodx
+from fingerprint import file_fingerprint
+
+try:
+    from PIL import Image
+except ImportError:
+    # Thumbnails are skipped.
+    Image = None
+
+try:
+    from ifstools import IFS
+except ImportError:
+    # Jackets are unpacked with the ifstools command instead.
+    IFS = None
 
 config = configparser.ConfigParser()
 config.read("config.ini")
@@ -14,14 +34,12 @@ preview_output_dir = config['Directories']['preview_audio_source_dir']
 jacket_output_dir = config['Directories']['jacket_source_dir']
 db_output_dir = config['Directories']['music_db_source_dir'] # TODO Extract music DB.
 game_contents_dir = config['Directories']['game_contents_dir']
-path_to_2dxdump = config['Utilities']['app_2dxdump_path']
 
-def clear_dir(path):
-    for f in os.listdir(path):
-        try:
-            os.remove(f'{path}/{f}')
-        except PermissionError:
-            rmtree(f'{path}/{f}')
+# Jackets that cannot be read directly are unpacked with ifstools, in their own directory under this one.
+WORK_DIR = '_temp'
+
+# Records what every extraction job was made from and what it wrote, so unchanged assets are skipped on the next run.
+MANIFEST_PATH = 'extract_manifest.sqlite'
 
 def wavname_from_2dx(song_file, song_id):
     if song_file.endswith('_1n.2dx'):
@@ -36,80 +54,270 @@ def wavname_from_2dx(song_file, song_id):
         return f'{song_id}_mxm.wav'
     return f'{song_id}.wav'
 
-def extract_data_dir(data_dir: str, is_mod_data: bool):
+# The game ID in the names of song, preview and jacket files, like "001_0123_1n.2dx" or "jk_001_0123_1_b.ifs".
+AUDIO_ID_PATTERN = re.compile(r'.{3}_([^_]+)_.*\.2dx')
+JACKET_ID_PATTERN = re.compile(r'jk_.{3}_([^_]+)_._b\.ifs')
+
+def list_dir(path):
+    """
+    :return: The names in a directory that `glob` would match, in the same order, or nothing if it does not exist.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if not entry.name.startswith('.')]
+    except FileNotFoundError:
+        return []
+
+def index_by_id(path, pattern):
+    """ Map the ID captured by `pattern` to the paths of the matching files in a directory, from a single listing. """
+    index = defaultdict(list)
+    for name in list_dir(path):
+        match = pattern.fullmatch(name)
+        if match is not None:
+            index[match.group(1)].append(f'{path}/{name}')
+    return index
+
+def index_by_label(path):
+    """ Map every prefix of a file name that ends before an underscore to the paths of the 2dx files with it. """
+    index = defaultdict(list)
+    for name in list_dir(path):
+        if not name.endswith('.2dx'):
+            continue
+        for i, c in enumerate(name):
+            if c == '_':
+                index[name[:i]].append(f'{path}/{name}')
+    return index
+
+class ExtractManifest:
+    """
+    The source files each extraction job was run on, and the files it wrote. A job is only run again when its sources
+    change or one of its outputs is missing.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            key TEXT PRIMARY KEY,
+            sources TEXT NOT NULL,
+            outputs TEXT NOT NULL
+        )''')
+        self.connection.commit()
+        # Files written during this run. A mod's job has to run again when the job for the data before it rewrote one of
+        #  its files, or the mod's version would be lost.
+        self.written = set()
+
+    def is_current(self, key, sources):
+        row = self.connection.execute('SELECT sources, outputs FROM jobs WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] != sources:
+            return False
+        return all(os.path.exists(output) and output not in self.written for output in json.loads(row[1]))
+
+    def put(self, key, sources, outputs):
+        self.connection.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)', (key, sources, json.dumps(outputs)))
+        self.connection.commit()
+        self.written.update(outputs)
+
+    def close(self):
+        self.connection.close()
+
+def extract_audio(audio_files, song_id, has_inf, output_dir, kind):
+    """
+    Copy the audio in each 2dx archive to `output_dir`.
+
+    :return: The paths of the files written.
+    """
+    outputs = []
+    for audio_file in audio_files:
+        with twodx.TwoDxArchive(audio_file) as archive:
+            # Certain songs store their extra INF audio as another file in the 2dx archive. However, old-style
+            # charts always have 8 files in the 2dx archive, so we check if there's EXACTLY 2 in the archive to
+            # see if it's an INF audio.
+            if len(archive) == 2:
+                # Actually, some songs follow that pattern but have no INF.
+                if has_inf:
+                    print(f'> Copying INF {kind} to "{song_id}_inf.wav".')
+                    archive.copy(1, f'{output_dir}/{song_id}_inf.wav')
+                    outputs.append(f'{output_dir}/{song_id}_inf.wav')
+
+            output_filename = wavname_from_2dx(audio_file, song_id)
+
+            print(f'> Copying {kind} to "{output_filename}".')
+            archive.copy(0, f'{output_dir}/{output_filename}')
+            outputs.append(f'{output_dir}/{output_filename}')
+    return outputs
+
+def read_jacket(jacket_file, image_name):
+    """ Decode a jacket texture with the ifstools library, without unpacking the rest of the archive. """
+    archive = IFS(jacket_file)
+    try:
+        size, pixels = archive.tree.folders['tex'].files[f'{image_name}.png'].load(raw_pixels=True)
+    finally:
+        archive.close()
+    return Image.frombytes('RGBA', size, pixels)
+
+def unpack_jacket(jacket_file, jacket_base, output_path):
+    """ Unpack a jacket with ifstools and copy its texture to `output_path`. """
+    with tempfile.TemporaryDirectory(dir=WORK_DIR) as work_dir:
+        subprocess.call(['ifstools', '--tex-only', os.path.abspath(jacket_file)], cwd=work_dir)
+        copyfile(f'{work_dir}/{jacket_base}_ifs/{jacket_base}.png', output_path)
+
+def extract_jackets(jacket_files, song_id, thumbnail_sizes):
+    """
+    Write each jacket, and a copy scaled to fit each of `thumbnail_sizes` in a subdirectory named after the size.
+
+    :return: The paths of the files written.
+    """
+    outputs = []
+    for jacket_file in jacket_files:
+        jacket_file_name = os.path.basename(jacket_file)
+        jacket_base = re.sub(r'\.ifs$', '', jacket_file_name)
+        jacket_idx = re.sub(r'jk_00[0-9]_[0-9]{4}_([1-9])_b.ifs', r'\1', jacket_file_name)
+        output_path = f'{jacket_output_dir}/{song_id}_{jacket_idx}.png'
+        print(f'> Copying jacket {jacket_base}.')
+
+        image = None
+        if IFS is not None:
+            # noinspection PyBroadException
+            try:
+                image = read_jacket(jacket_file, jacket_base)
+                image.save(output_path)
+            except Exception as e:
+                # ifstools raises all sorts of errors for unsupported formats and corrupt archives. The command gets a
+                #  second try, and a job that still fails is reported and retried on the next run.
+                print(f'> Unable to read jacket {jacket_base} directly ({e}), unpacking it with ifstools.')
+                image = None
+        if image is None:
+            unpack_jacket(jacket_file, jacket_base, output_path)
+        outputs.append(output_path)
+
+        for size in thumbnail_sizes:
+            if image is None:
+                image = Image.open(output_path)
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            os.makedirs(f'{jacket_output_dir}/{size}', exist_ok=True)
+            thumbnail.save(f'{jacket_output_dir}/{size}/{song_id}_{jacket_idx}.png')
+            outputs.append(f'{jacket_output_dir}/{size}/{song_id}_{jacket_idx}.png')
+    return outputs
+
+MusicEntry = namedtuple('MusicEntry', ['song_id', 'label', 'inf_ver'])
+
+def iter_music_db(path):
+    """
+    Yield the fields of every song in a music DB as soon as its element is parsed. Each element is dropped afterwards,
+    so only one song is held in memory at a time.
+    """
+    with open(path, encoding='shift_jisx0213') as db_file:
+        root = None
+        for event, element in ET.iterparse(db_file, events=('start', 'end')):
+            if root is None:
+                root = element
+            elif event == 'end' and element.tag == 'music':
+                yield MusicEntry(element.attrib['id'], element.find('info/label').text,
+                                 element.find('info/inf_ver').text)
+                root.clear()
+
+def extract_data_dir(data_dir: str, is_mod_data: bool, executor, manifest, thumbnail_sizes):
+    """
+    Submit the extraction jobs for every song in a data directory to `executor`. Each song's songs, previews and
+    jackets are separate jobs, since they write to different files. Jobs that are current in `manifest` are skipped.
+
+    :return: A dict of the futures of the submitted jobs to their manifest key and sources.
+    """
+    futures = {}
+
+    def submit(kind, source_files, function, *args):
+        key = f'{data_dir}:{kind}:{song_id}'
+        sources = json.dumps({'files': [[file, file_fingerprint(file)] for file in source_files], 'args': args})
+        if manifest.is_current(key, sources):
+            return
+        futures[executor.submit(function, source_files, song_id, *args)] = (key, sources)
+
+    # Each directory is listed once up front instead of globbed once per song, which gets slow with thousands of songs.
+    sound_by_label = index_by_label(f'{data_dir}/sound')
+    sound_by_id = index_by_id(f'{data_dir}/sound', AUDIO_ID_PATTERN)
+    previews_by_id = index_by_id(f'{data_dir}/sound/preview', AUDIO_ID_PATTERN)
+    jackets_by_id = index_by_id(f'{data_dir}/graphics/jk', JACKET_ID_PATTERN)
+
     music_db = f'{data_dir}/others/{"music_db.merged.xml" if is_mod_data == True else "music_db.xml"}'
-    with open(music_db, encoding='shift_jisx0213') as db_file:
-        tree = ET.fromstring(db_file.read())
-        for child in tree:
-            song_id = child.attrib['id']
-            print(f'> Processing {song_id}.')
-
-            song_files = []
-            # "weird" songs have a label field like "1n0001" or whatever.
-            # They have their audio files in a different naming format than most, starting with label instead of game
-            #  ID.
-            if re.search(r'[a-z]', child.find('info/label').text) is not None:
-                try:
-                    for song_file in glob.glob(f'{data_dir}/sound/{child.find("info/label").text}_*.2dx'):
-                        song_files.append(song_file)
-                except StopIteration: pass
-            if len(song_files) == 0:
-                for song_file in glob.glob(f'{data_dir}/sound/???_{str(song_id).zfill(4)}_*.2dx'):
-                    song_files.append(song_file)
-
-            for song_file in song_files:
-                subprocess.call([path_to_2dxdump, song_file])
-
-                # Certain songs store their extra INF audio as another file in the 2dx archive. However, old-style
-                # charts always have 8 files in the 2dx archive, so we check if there's EXACTLY 2 in the archive to
-                # see if it's an INF audio.
-                if os.path.exists('1.wav') and not os.path.exists('2.wav'):
-                    # Actually, some songs follow that pattern but have no INF.
-                    if child.find('info/inf_ver').text != '0':
-                        print(f'> Copying INF song to "{song_id}_inf.wav".')
-                        copyfile('1.wav', f'{song_output_dir}/{song_id}_inf.wav')
-
-                output_filename = wavname_from_2dx(song_file, song_id)
-
-                print(f'> Copying song to "{output_filename}".')
-                copyfile('0.wav', f'{song_output_dir}/{output_filename}')
-
-                clear_dir('.')
-
-            preview_files = list(glob.glob(f'{data_dir}/sound/preview/???_{str(song_id).zfill(4)}_*.2dx'))
-            for preview_file in preview_files:
-                subprocess.call(['C:/Tools/2dxDump.exe', preview_file])
-
-                if os.path.exists('1.wav') and not os.path.exists('2.wav'):
-                    print(f'> Copying INF preview to "{song_id}_inf.wav".')
-                    copyfile('1.wav', f'{song_output_dir}/{song_id}_inf.wav')
-
-                output_filename = wavname_from_2dx(preview_file, song_id)
-
-                print(f'> Copying preview to "{output_filename}".')
-                copyfile('0.wav', f'{preview_output_dir}/{output_filename}')
-                clear_dir('.')
-
-            jacket_files = glob.glob(f'{data_dir}/graphics/jk/jk_???_{str(song_id).zfill(4)}_?_b.ifs')
-            for jacket_file in jacket_files:
-                subprocess.call(['ifstools', '--tex-only', jacket_file])
-                jacket_file = os.path.basename(jacket_file)
-                jacket_base = re.sub(r'\.ifs$', '', jacket_file)
-                jacket_idx = re.sub(r'jk_00[0-9]_[0-9]{4}_([1-9])_b.ifs', r'\1', jacket_file)
-                print(f'> Copying jacket {jacket_base}.')
-                copyfile(f'{jacket_base}_ifs/{jacket_base}.png', f'{jacket_output_dir}/{song_id}_{jacket_idx}.png')
-                clear_dir('.')
+    # Jobs are submitted while the rest of the DB is still being parsed.
+    for song_id, label, inf_ver in iter_music_db(music_db):
+        print(f'> Processing {song_id}.')
 
-try:
-    os.mkdir('_temp')
-except FileExistsError:
-    pass
+        song_files = []
+        # "weird" songs have a label field like "1n0001" or whatever.
+        # They have their audio files in a different naming format than most, starting with label instead of game
+        #  ID.
+        if re.search(r'[a-z]', label) is not None:
+            song_files = list(sound_by_label.get(label, []))
+        if len(song_files) == 0:
+            song_files = list(sound_by_id.get(str(song_id).zfill(4), []))
+        has_inf = inf_ver != '0'
+
+        submit('song', song_files, extract_audio, has_inf, song_output_dir, 'song')
+
+        preview_files = list(previews_by_id.get(str(song_id).zfill(4), []))
+        submit('preview', preview_files, extract_audio, True, preview_output_dir, 'preview')
+
+        jacket_files = list(jackets_by_id.get(str(song_id).zfill(4), []))
+        submit('jacket', jacket_files, extract_jackets, thumbnail_sizes)
+    return futures
 
-os.chdir('_temp')
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                           help='The number of files to extract at once.')
+    argparser.add_argument('-t', '--threads', action='store_true', dest='use_threads',
+                           help='Use worker threads instead of worker processes.')
+    argparser.add_argument('-s', '--jacket-thumbnail-size', type=int, action='append', default=[],
+                           dest='thumbnail_sizes', metavar='SIZE',
+                           help='Also write each jacket scaled to fit SIZE pixels, in a directory named SIZE inside the '
+                                'jacket directory. Can be given more than once. Needs Pillow.')
+    argparser.add_argument('-m', '--mods-only', action='store_true',
+                           help='Only extract the data directories in data_mods.')
+    argparser.add_argument('-f', '--force', action='store_true',
+                           help='Extract everything again, even if it is unchanged since the last run.')
+    args = argparser.parse_args()
 
-extract_data_dir('data', False)
+    try:
+        os.mkdir(WORK_DIR)
+    except FileExistsError:
+        pass
+
+    data_dirs = [] if args.mods_only else [(f'{game_contents_dir}/data', False)]
+    game_mod_data_dir = f'{game_contents_dir}/data_mods'
+    if os.path.isdir(game_mod_data_dir):
+        for mod_dir in sorted(os.listdir(game_mod_data_dir)):
+            data_dirs.append((f'{game_mod_data_dir}/{mod_dir}', True))
+
+    if args.thumbnail_sizes and Image is None:
+        print('Jacket thumbnails need Pillow, which is not installed. Skipping them.')
+        args.thumbnail_sizes = []
+
+    if args.force and os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)
+    manifest = ExtractManifest(MANIFEST_PATH)
+
+    # Decoding jackets is CPU bound, so processes are used by default.
+    executor_type = ThreadPoolExecutor if args.use_threads else ProcessPoolExecutor
+    with executor_type(max_workers=args.jobs) as executor:
+        for data_dir, is_mod_data in data_dirs:
+            # Mods overwrite the files of the data directories before them, so each one is finished before the next
+            #  is started.
+            futures = extract_data_dir(data_dir, is_mod_data, executor, manifest,
+                                       args.thumbnail_sizes)
+            print(f'> {len(futures)} jobs to run in "{data_dir}".')
+            for future in as_completed(futures):
+                # Recorded as each job finishes, so an interrupted run only repeats the jobs it did not finish.
+                key, sources = futures[future]
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    # Left out of the manifest, so the next run tries it again.
+                    _, kind, song_id = key.rsplit(':', 2)
+                    print(f'>> Extracting the {kind} of {song_id} failed: {e}')
+                    continue
+                manifest.put(key, sources, outputs)
+    manifest.close()
 
-game_mod_data_dir = f'{game_contents_dir}/data_mods'
-if os.path.isdir(game_mod_data_dir):
-    for mod_dir in os.listdir(game_mod_data_dir):
-        extract_data_dir(mod_dir, True)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+import os
+
+def file_fingerprint(path):
+    """
+    :return: The size and modification time of a file, which change whenever it is rewritten, or None if it does not
+    exist. Used by every cache that decides whether work can be skipped, so they all agree on what a change is.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3.7
+import argparse
+import json
+import sys
+
+import run_report
+
+def main():
+    argparser = argparse.ArgumentParser(description='Combine the run reports of converter.py shards')
+    argparser.add_argument('reports', nargs='+', metavar='REPORT', help='The debug/run_report.json of each shard.')
+    argparser.add_argument('-o', '--output', default='run_report.json', help='Where to write the combined report.')
+    args = argparser.parse_args()
+
+    reports = []
+    for path in args.reports:
+        with open(path, encoding='utf-8') as file:
+            reports.append(json.load(file))
+    merged = run_report.merge(reports)
+
+    # Point out shards that are missing or were given twice, since the totals would be off.
+    counts = {shard['count'] for shard in merged['shards']}
+    if len(counts) > 1:
+        print(f'Warning: the reports are from runs with different shard counts {sorted(counts)}.', file=sys.stderr)
+    elif len(counts) == 1:
+        indices = [shard['index'] for shard in merged['shards']]
+        missing = sorted(set(range(1, counts.pop() + 1)) - set(indices))
+        duplicated = sorted({i for i in indices if indices.count(i) > 1})
+        if missing:
+            print(f'Warning: no report for shards {missing}.', file=sys.stderr)
+        if duplicated:
+            print(f'Warning: more than one report for shards {duplicated}.', file=sys.stderr)
+
+    outputs = [entry['output'] for entry in merged['manifest']]
+    if len(outputs) != len(set(outputs)):
+        print('Warning: some charts were written by more than one shard.', file=sys.stderr)
+
+    run_report.print_report(merged)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(merged, file, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -4,77 +4,293 @@
 import argparse
 import configparser
 import glob
+import importlib.util
+import json
 import pickle
 import os
+import re
+import shutil
+import subprocess
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from xml.etree import ElementTree
-from threading import Thread
-
-from pydub import AudioSegment
-
-argparser = argparse.ArgumentParser()
-argparser.add_argument('-c', '--num-cores', type=int, default=3)
-argparser.add_argument('-e', '--src-audio-extension', default='ogg')
-argparser.add_argument('-n', '--normalize', action='store_true', dest='do_normalize',
-                       help='Normalize the audio. Not needed in most cases since volume is handled in the chart '
-                            'metadata.')
-args = argparser.parse_args()
-
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-song_source_dir = config['Directories']['song_audio_source_dir']
-preview_source_dir = config['Directories']['preview_audio_source_dir']
-output_dir = config['Directories']['combined_song_preview_audio_dir']
-db_source_dir = config['Directories']['music_db_source_dir']
-preview_offset = int(config['Audio']['hidden_preview_position']) * 1000
-
-print(f'Inserting previews at {preview_offset}ms.')
-
-db_entries = []
-for db_file in glob.glob(f'{db_source_dir}/*.xml'):
-    with open(db_file, encoding='shift_jisx0213') as file:
-        db_entries += ElementTree.fromstring(file.read())
-
-workpool = [[] for _ in range(args.num_cores)]
-for i, songfile in enumerate(glob.glob(f'{song_source_dir}/*.{args.src_audio_extension}')):
-    workpool[i % len(workpool)].append(songfile)
-
-volume_chart = []
-
-def process_pool(songpool):
-    for song in songpool:
-        song_id = os.path.splitext(os.path.basename(song))[0].split('_')[0]
-
-        # Find volume tag for chart data.
-        try:
-            chart_entry = int(
-                next(filter(lambda entry: entry.attrib['id'] == song_id, db_entries)).find('info/volume').text)
-        except StopIteration:
-            chart_entry = None
-
-        print(f'>> Processing {song_id}.')
-        if os.path.exists(f'{output_dir}/{os.path.basename(song)}'):
-            print('Already exists, skipping.')
+
+import volume_table
+from fingerprint import file_fingerprint
+
+# Everything is resampled to this before concatenation, since ffmpeg's concat filter needs matching formats.
+SAMPLE_RATE = 44100
+CHANNEL_LAYOUT = 'stereo'
+VORBIS_QUALITY = '7'
+
+# Streaming sample peak and integrated loudness measurement. The results are logged when ffmpeg exits.
+MEASURE_FILTER = 'ebur128=peak=sample:framelog=quiet'
+
+AudioJob = namedtuple('AudioJob', ['name', 'song_id', 'song_path', 'preview_path', 'output_path', 'volume',
+                                   'inputs'])
+
+# The measurements of a prepared file. `gain` is what was applied to normalize it.
+Measurement = namedtuple('Measurement', ['peak', 'loudness', 'gain'])
+
+def load_song_volumes(db_source_dir):
+    """ Read the volume tag for chart data from every DB file, keyed by song ID. """
+    song_volumes = {}
+    for db_file in glob.glob(f'{db_source_dir}/*.xml'):
+        with open(db_file, encoding='shift_jisx0213') as file:
+            for entry in ElementTree.fromstring(file.read()):
+                volume = entry.find('info/volume')
+                song_volumes.setdefault(entry.attrib['id'], int(volume.text) if volume is not None else None)
+    return song_volumes
+
+def plan_jobs(song_source_dir, preview_source_dir, output_dir, extension, song_volumes, table, preview_offset,
+              do_normalize, pipeline, copy_song_stream):
+    """
+    Resolve the preview, output path and volume of every song before any audio work starts. Songs are skipped if their
+    output exists and was prepared from the same inputs and settings, according to the volume table.
+    """
+    jobs = []
+    for song in glob.glob(f'{song_source_dir}/*.{extension}'):
+        name = os.path.splitext(os.path.basename(song))[0]
+        song_id = name.split('_')[0]
+        output_path = f'{output_dir}/{os.path.basename(song)}'
+        preview_path = f'{preview_source_dir}/{song_id}.{extension}'
+        inputs = json.dumps({'song': file_fingerprint(song), 'preview': file_fingerprint(preview_path),
+                             'preview_offset': preview_offset, 'normalize': do_normalize, 'pipeline': pipeline,
+                             'copy_song_stream': copy_song_stream}, sort_keys=True)
+
+        row = table.get(name)
+        if os.path.exists(output_path) and row is not None and row['inputs'] == inputs:
+            print(f'>> {song_id}: "{output_path}" is up to date, skipping.')
             continue
+        jobs.append(AudioJob(name, song_id, song, preview_path, output_path, song_volumes.get(song_id), inputs))
+    return jobs
+
+def ffmpeg_concat_graph(preview_offset, gain=None):
+    """
+    Build the filtergraph that pads the song with silence up to the preview offset and appends the preview. The
+    result is measured with ebur128 as it streams through, so nothing has to be held in Python.
+    """
+    audio_format = f'aresample={SAMPLE_RATE},aformat=sample_fmts=fltp:channel_layouts={CHANNEL_LAYOUT}'
+    graph = f'[0:a]{audio_format},apad=whole_dur={preview_offset}ms[song];' \
+            f'[1:a]{audio_format}[preview];' \
+            f'[song][preview]concat=n=2:v=0:a=1'
+    if gain is not None:
+        graph += f',volume={gain}dB'
+    return graph + f',{MEASURE_FILTER}[out]'
+
+def run_ffmpeg(arguments, stdout=subprocess.DEVNULL):
+    """
+    Run ffmpeg with the given arguments, raising if it fails.
+    :return: ffmpeg's log output.
+    """
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-nostats', '-y'] + arguments, stdout=stdout,
+                            stderr=subprocess.PIPE, encoding='utf-8', errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg exited with code {result.returncode}: {result.stderr.strip()[-500:]}')
+    return result.stderr
+
+def parse_measurement(ffmpeg_log, gain=0.0):
+    """ :return: The Measurement reported by the MEASURE_FILTER in an ffmpeg run. """
+    # Some ffmpeg versions configure the graph twice and log an empty summary first, so the last one is used.
+    loudness = re.findall(r'Integrated loudness:\s+I:\s+(-?[0-9.]+|-inf) LUFS', ffmpeg_log)
+    peak = re.findall(r'Sample peak:\s+Peak:\s+(-?[0-9.]+|-inf) dBFS', ffmpeg_log)
+    if len(loudness) == 0 or len(peak) == 0:
+        raise RuntimeError('ffmpeg did not report the peak and loudness')
+    return Measurement(float(peak[-1]), float(loudness[-1]), gain)
+
+def measure_file(path):
+    """ Measure an audio file by streaming it through ffmpeg. """
+    return parse_measurement(run_ffmpeg(['-i', path, '-af', MEASURE_FILTER, '-f', 'null', '-']))
+
+def probe_audio(path):
+    """ :return: The container format, duration and first audio stream's properties of a file, using ffprobe. """
+    result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-of', 'json', '-show_entries',
+                             'stream=codec_name,sample_rate,channel_layout:format=format_name,duration', path],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf-8')
+    if result.returncode != 0:
+        raise RuntimeError(f'ffprobe could not read "{path}"')
+    probe = json.loads(result.stdout)
+    return probe['format'], probe['streams'][0] if len(probe['streams']) > 0 else None
+
+def run_ffmpeg_concat(job, preview_offset, output_args, gain=None):
+    """
+    Run the concat filtergraph for a job.
+    :return: The Measurement of the output.
+    """
+    return parse_measurement(run_ffmpeg(['-i', job.song_path, '-i', job.preview_path,
+                                         '-filter_complex', ffmpeg_concat_graph(preview_offset, gain),
+                                         '-map', '[out]'] + output_args), gain or 0.0)
+
+def process_job_ffmpeg(job, preview_offset, do_normalize):
+    """ Create the combined file with a single streaming ffmpeg filtergraph. Memory use does not depend on length. """
+    gain = None
+    if do_normalize:
+        # Normalizing needs the peak up front, so measure it in a pass that discards the audio.
+        gain = -run_ffmpeg_concat(job, preview_offset, ['-f', 'null', '-']).peak
+    return run_ffmpeg_concat(job, preview_offset, ['-c:a', 'libvorbis', '-q:a', VORBIS_QUALITY, '-f', 'ogg',
+                                                   job.output_path], gain)
+
+def ogg_serial_number(path):
+    """ :return: The bitstream serial number of the first page of an Ogg file. """
+    with open(path, 'rb') as file:
+        header = file.read(18)
+    if len(header) < 18 or header[:4] != b'OggS':
+        raise ValueError(f'"{path}" is not an Ogg file')
+    return int.from_bytes(header[14:18], 'little')
+
+def process_job_copy_song(job, preview_offset):
+    """
+    Create the combined file without re-encoding the song: the song's Ogg Vorbis stream is copied as-is and the
+    silence and preview are encoded as a second Ogg stream chained after it.
+    :return: The Measurement, or None if the song is not Ogg Vorbis and has to go through a normal pipeline.
+    """
+    song_format, song_stream = probe_audio(job.song_path)
+    if song_stream is None or song_stream['codec_name'] != 'vorbis' or 'ogg' not in song_format['format_name']:
+        return None
+
+    # The chained stream must match the song's format, or players will switch formats halfway through.
+    audio_format = f'aresample={song_stream["sample_rate"]},' \
+                   f'aformat=sample_fmts=fltp:channel_layouts={song_stream.get("channel_layout", CHANNEL_LAYOUT)}'
+    silence = preview_offset / 1000 - float(song_format['duration'])
+    if silence > 0:
+        inputs = ['-f', 'lavfi', '-t', f'{silence:.6f}', '-i', f'anullsrc=r={song_stream["sample_rate"]}',
+                  '-i', job.preview_path]
+        graph = f'[0:a]{audio_format}[silence];[1:a]{audio_format}[preview];' \
+                f'[silence][preview]concat=n=2:v=0:a=1[out]'
+    else:
+        inputs = ['-i', job.preview_path]
+        graph = f'[0:a]{audio_format}[out]'
+
+    # Chained streams need distinct serial numbers.
+    serial_offset = (ogg_serial_number(job.song_path) + 1) & 0x7FFFFFFF
+
+    with open(job.output_path, 'wb') as output:
+        with open(job.song_path, 'rb') as song:
+            shutil.copyfileobj(song, output)
+        output.flush()
+        run_ffmpeg(inputs + ['-filter_complex', graph, '-map', '[out]', '-c:a', 'libvorbis', '-q:a', VORBIS_QUALITY,
+                             '-serial_offset', str(serial_offset), '-fflags', '+bitexact', '-f', 'ogg', 'pipe:1'],
+                   stdout=output)
+
+    # The result is only decoded, not encoded, to measure it.
+    return measure_file(job.output_path)
+
+def process_job_pydub(job, preview_offset, do_normalize):
+    """ Create the combined file by decoding everything into memory with pydub. """
+    # pydub is only needed for this pipeline, so it is imported here.
+    from pydub import AudioSegment
+
+    # Append silence followed by the preview.
+    audio = AudioSegment.from_file(job.song_path)
+    audio = audio.append(AudioSegment.silent(duration=preview_offset-len(audio)), crossfade=0) \
+        .append(AudioSegment.from_file(job.preview_path), crossfade=0)
+    peak = audio.max_dBFS
+    if do_normalize:
+        audio = audio.apply_gain(-peak)
+
+    audio.export(job.output_path, format='ogg', parameters=['-q:a', VORBIS_QUALITY])
+    # pydub has no loudness measurement.
+    return Measurement(audio.max_dBFS, None, -peak if do_normalize else 0.0)
+
+def process_job(job, preview_offset, do_normalize, pipeline, copy_song_stream):
+    """
+    Create the combined song and preview file for one song. Runs in a worker process, so everything it needs is passed
+    in.
+    :return: The Measurement of the prepared file.
+    """
+    print(f'>> Processing {job.song_id}.')
+
+    # Everything is written to a temporary file that is only renamed into place once it is complete, so an
+    #  interrupted run never leaves a truncated file that looks finished.
+    output_path = job.output_path
+    job = job._replace(output_path=f'{output_path}.tmp')
+    try:
+        measurement = None
+        if copy_song_stream:
+            measurement = process_job_copy_song(job, preview_offset)
+            if measurement is None:
+                print(f'>> {job.song_id}: Song is not Ogg Vorbis, re-encoding it.')
+        if measurement is None and pipeline == 'ffmpeg':
+            measurement = process_job_ffmpeg(job, preview_offset, do_normalize)
+        elif measurement is None:
+            measurement = process_job_pydub(job, preview_offset, do_normalize)
+        os.replace(job.output_path, output_path)
+    finally:
+        if os.path.exists(job.output_path):
+            os.remove(job.output_path)
+
+    return measurement
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-c', '--num-cores', type=int, default=os.cpu_count())
+    argparser.add_argument('-t', '--threads', action='store_true', dest='use_threads',
+                           help='Use worker threads instead of worker processes.')
+    argparser.add_argument('-e', '--src-audio-extension', default='ogg')
+    argparser.add_argument('-p', '--pipeline', choices=['ffmpeg', 'pydub'], default='ffmpeg',
+                           help='Build the combined file with one streaming ffmpeg filtergraph, or by decoding it into '
+                                'memory with pydub.')
+    argparser.add_argument('-n', '--normalize', action='store_true', dest='do_normalize',
+                           help='Normalize the audio. Not needed in most cases since volume is handled in the chart '
+                                'metadata.')
+    argparser.add_argument('-s', '--copy-song-stream', action='store_true',
+                           help='Keep the Vorbis stream of Ogg Vorbis songs instead of re-encoding it, and chain the '
+                                'silence and preview after it as a second Ogg stream. Not compatible with '
+                                '--normalize.')
+    args = argparser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+
+    song_source_dir = config['Directories']['song_audio_source_dir']
+    preview_source_dir = config['Directories']['preview_audio_source_dir']
+    output_dir = config['Directories']['combined_song_preview_audio_dir']
+    db_source_dir = config['Directories']['music_db_source_dir']
+    preview_offset = int(config['Audio']['hidden_preview_position']) * 1000
+
+    print(f'Inserting previews at {preview_offset}ms.')
+
+    if args.pipeline == 'ffmpeg' and shutil.which('ffmpeg') is None:
+        print('Could not find ffmpeg, falling back to pydub.')
+        args.pipeline = 'pydub'
+    if args.pipeline == 'pydub' and importlib.util.find_spec('pydub') is None:
+        print('The pydub pipeline needs pydub, which is not installed. Install it, or install ffmpeg and use the '
+              'default pipeline.', file=sys.stderr)
+        sys.exit(1)
+    if args.copy_song_stream and (args.do_normalize or shutil.which('ffmpeg') is None
+                                  or shutil.which('ffprobe') is None):
+        print('Copying the song stream needs ffmpeg and ffprobe, and cannot be combined with normalizing. '
+              'Songs will be re-encoded.')
+        args.copy_song_stream = False
+
+    table = volume_table.VolumeTable(f'{output_dir}/{volume_table.TABLE_FILENAME}')
+    jobs = plan_jobs(song_source_dir, preview_source_dir, output_dir, args.src_audio_extension,
+                     load_song_volumes(db_source_dir), table, preview_offset, args.do_normalize, args.pipeline,
+                     args.copy_song_stream)
+
+    # Songs are handed out one at a time, so a worker that finishes early picks up the next song instead of idling.
+    executor_class = ThreadPoolExecutor if args.use_threads else ProcessPoolExecutor
+    with executor_class(max_workers=args.num_cores) as executor:
+        futures = {executor.submit(process_job, job, preview_offset, args.do_normalize, args.pipeline,
+                                   args.copy_song_stream): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                measurement = future.result()
+            except Exception as e:
+                print(f'>> Processing {job.song_id} failed: {e}')
+                continue
+            # Written as each song finishes, so an interrupted run keeps its progress.
+            table.put(job.name, job.song_id, job.volume, measurement.peak, measurement.loudness, measurement.gain,
+                      job.inputs)
+
+    # The volume chart plots the DB volume against the peak before normalization.
+    volume_chart = [(row['db_volume'], row['peak'] - row['gain']) for row in table.rows()
+                    if row['db_volume'] is not None]
+    table.close()
+    with open('out/volume_chart.bin', 'wb') as file:
+        pickle.dump(volume_chart, file, pickle.HIGHEST_PROTOCOL)
 
-        # Append silence followed by the preview.
-        audio = AudioSegment.from_file(song)
-        audio = audio.append(AudioSegment.silent(duration=preview_offset-len(audio)), crossfade=0) \
-            .append(AudioSegment.from_file(f'{preview_source_dir}/{song_id}.{args.src_audio_extension}'), crossfade=0)
-        if chart_entry is not None:
-            # Add to graph.
-            chart_entry = (chart_entry, audio.max_dBFS)
-            volume_chart.append(chart_entry)
-        if args.do_normalize:
-            audio = audio.apply_gain(-audio.max_dBFS)
-
-        audio.export(f'{output_dir}/{os.path.basename(song)}', format='ogg', parameters=['-q:a', '7'])
-
-threadpool = [Thread(target=process_pool, args=(workpool[i],)) for i in range(args.num_cores)]
-for thread in threadpool:
-    thread.start()
-for thread in threadpool:
-    thread.join()
-
-with open('out/volume_chart.bin', 'wb') as file:
-    pickle.dump(volume_chart, file, pickle.HIGHEST_PROTOCOL)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+
+# The queue records are sent to, set by `RunLog.start`. Worker processes have none, so they only print console records
+#  and drop the rest.
+_queue = None
+
+def install(record_queue):
+    """ Send this process's records to `record_queue`, or drop them if it is None. """
+    global _queue
+    _queue = record_queue
+
+def worker_name():
+    process = multiprocessing.current_process()
+    thread = threading.current_thread()
+    return thread.name if process.name == 'MainProcess' else f'{process.name}/{thread.name}'
+
+def emit(kind, message, console=False, **fields):
+    """
+    Enqueue a structured record. All formatting and I/O is left to the writer thread, so this is cheap enough to call
+    for every abnormality.
+    """
+    record = {'time': time.time(), 'worker': worker_name(), 'kind': kind, 'message': message, 'console': console}
+    record.update(fields)
+    if _queue is None:
+        if console:
+            print(f'{record["worker"]}> {message}')
+        return
+    _queue.put(record)
+
+def message(text):
+    """ Log a progress message that is also shown on the console. """
+    emit('message', text, console=True)
+
+class RunLog:
+    """
+    Writes the records of every worker from a single background thread. Records are batched to a JSON lines file, and
+    those marked for the console are printed as well.
+    """
+    BATCH_SIZE = 512
+
+    def __init__(self, path, console=sys.stdout):
+        """
+        :param path: The JSON lines file to write.
+        :param console: Where to print console records.
+        """
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.console = console
+        self.thread = None
+
+    def start(self):
+        install(self.queue)
+        self.thread = threading.Thread(target=self._run, name='RunLog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Flush every pending record and stop the writer thread. """
+        install(None)
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            running = True
+            while running:
+                batch = [self.queue.get()]
+                while len(batch) < self.BATCH_SIZE:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                lines = []
+                for record in batch:
+                    if record is None:
+                        running = False
+                        continue
+                    lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+                    if record['console']:
+                        print(f'{record["worker"]}> {record["message"]}', file=self.console)
+                file.writelines(lines)
+                file.flush()
+                self.console.flush()
@@ -0,0 +1,39 @@
+import sys
+from enum import Enum
+
+class Level(Enum):
+    """ How serious an issue found in a chart is. The values are the keys used in run reports. """
+    ABNORMALITY = 'abnormal'
+    WARNING = 'warning'
+    ERROR = 'error'
+
+def merge(reports):
+    """ Combine the run reports of several shards into one, as if a single run had converted every chart. """
+    merged = {'phases': {}, 'counters': {}, 'issues': {level.value: 0 for level in Level}, 'charts': [],
+              'shards': [], 'manifest': []}
+    for report in reports:
+        for name, timing in report['phases'].items():
+            phase = merged['phases'].setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            phase['wall'] += timing['wall']
+            phase['cpu'] += timing['cpu']
+        for name, amount in report['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + amount
+        for level, count in report['issues'].items():
+            merged['issues'][level] = merged['issues'].get(level, 0) + count
+        merged['charts'] += report['charts']
+        if report.get('shard') is not None:
+            merged['shards'].append(report['shard'])
+        merged['manifest'] += report.get('manifest', [])
+    merged['shards'].sort(key=lambda shard: shard['index'])
+    merged['manifest'].sort(key=lambda entry: entry['output'])
+    return merged
+
+def print_report(report, file=sys.stdout):
+    print(f'{"Phase":<12}{"Wall (s)":>12}{"CPU (s)":>12}', file=file)
+    for name, phase in report['phases'].items():
+        print(f'{name:<12}{phase["wall"]:>12.3f}{phase["cpu"]:>12.3f}', file=file)
+    print(f'{"Counter":<16}{"Total":>12}', file=file)
+    for name, amount in report['counters'].items():
+        print(f'{name:<16}{amount:>12}', file=file)
+    print(f'Processed {len(report["charts"])} charts with {report["issues"]["abnormal"]} abnormalities, '
+          f'{report["issues"]["warning"]} warnings, and {report["issues"]["error"]} errors.', file=file)
@@ -0,0 +1,65 @@
+import struct
+
+# The archive header: a name, the size of the header, the number of files, and unknown data. It is followed by the
+#  offset of every file.
+ARCHIVE_HEADER = struct.Struct('<16sII48x')
+# The header of each file: magic, size of the header, size of the WAV data, and playback settings that are not needed.
+FILE_HEADER = struct.Struct('<4sII')
+FILE_MAGIC = b'2DX9'
+
+COPY_CHUNK_SIZE = 1 << 20
+
+class TwoDxArchive:
+    """
+    Reads the WAV files in a 2dx archive. Only the headers are read when opening it, and each WAV is streamed straight
+    to its destination when copied. The files are numbered in the same order 2dxDump names them (0.wav, 1.wav, ...).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.entries = self._read_entries()
+        except Exception:
+            self.file.close()
+            raise
+
+    def _read_entries(self):
+        """ :return: The offset and size of the WAV data of every file. """
+        header = self.file.read(ARCHIVE_HEADER.size)
+        if len(header) != ARCHIVE_HEADER.size:
+            raise ValueError(f'"{self.path}" is too short to be a 2dx archive')
+        _, _, file_count = ARCHIVE_HEADER.unpack(header)
+        offsets = struct.unpack(f'<{file_count}I', self.file.read(4 * file_count))
+
+        entries = []
+        for offset in offsets:
+            self.file.seek(offset)
+            magic, header_size, wav_size = FILE_HEADER.unpack(self.file.read(FILE_HEADER.size))
+            if magic != FILE_MAGIC:
+                raise ValueError(f'bad file header at offset {offset} in "{self.path}"')
+            entries.append((offset + header_size, wav_size))
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def copy(self, index, destination):
+        """ Write the WAV file at `index` to the path `destination`. """
+        offset, remaining = self.entries[index]
+        self.file.seek(offset)
+        with open(destination, 'wb') as output:
+            while remaining > 0:
+                chunk = self.file.read(min(remaining, COPY_CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError(f'file {index} in "{self.path}" is truncated')
+                output.write(chunk)
+                remaining -= len(chunk)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
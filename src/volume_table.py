@@ -0,0 +1,63 @@
+import sqlite3
+
+# Stored next to the combined song and preview audio files it describes.
+TABLE_FILENAME = 'volume_table.sqlite'
+
+class VolumeTable:
+    """
+    Peak and integrated loudness measurements of the prepared audio files, keyed by file name without extension (the
+    song ID, plus the difficulty for difficulty-specific audio). Each row also records the inputs the file was prepared
+    from, which makes the table the manifest used to decide whether a file is up to date. Rows are committed as soon as
+    they are written, so a crashed run keeps everything finished so far.
+    """
+    COLUMNS = ['name', 'song_id', 'db_volume', 'peak', 'loudness', 'gain', 'inputs']
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS volumes (
+            name TEXT PRIMARY KEY,
+            song_id TEXT NOT NULL,
+            db_volume INTEGER,
+            peak REAL,
+            loudness REAL,
+            gain REAL NOT NULL DEFAULT 0,
+            inputs TEXT
+        )''')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(volumes)')]
+        if 'inputs' not in columns:
+            # Tables from before the inputs were recorded.
+            self.connection.execute('ALTER TABLE volumes ADD COLUMN inputs TEXT')
+        self.connection.commit()
+
+    def get(self, name):
+        """ :return: The row for the given file as a dict, or None if it has not been measured. """
+        row = self.connection.execute(f'SELECT {", ".join(self.COLUMNS)} FROM volumes WHERE name = ?',
+                                      (name,)).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row is not None else None
+
+    def put(self, name, song_id, db_volume, peak, loudness, gain=0.0, inputs=None):
+        """
+        :param peak: The sample peak of the prepared file in dBFS.
+        :param loudness: The integrated loudness of the prepared file in LUFS, or None if it was not measured.
+        :param gain: The gain applied when preparing the file, if it was normalized.
+        :param inputs: A string identifying the inputs and settings the file was prepared from.
+        """
+        self.connection.execute(f'INSERT OR REPLACE INTO volumes ({", ".join(self.COLUMNS)}) '
+                                f'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (name, song_id, db_volume, peak, loudness, gain, inputs))
+        self.connection.commit()
+
+    def rows(self):
+        return [dict(zip(self.COLUMNS, row)) for row in
+                self.connection.execute(f'SELECT {", ".join(self.COLUMNS)} FROM volumes ORDER BY name')]
+
+    def close(self):
+        self.connection.close()
+
+def load(path):
+    """ Read a whole volume table into a dict keyed by name, for read-only use from several threads. """
+    table = VolumeTable(path)
+    try:
+        return {row['name']: row for row in table.rows()}
+    finally:
+        table.close()